@@ -3,7 +3,10 @@ import os
 import asyncio
 from collections import defaultdict
 from telethon import TelegramClient, events, utils
-from telethon.tl.types import MessageService, MessageActionTopicCreate
+from telethon.tl.types import (
+    MessageService, MessageActionTopicCreate, InputMessagesFilterPhotoVideo, InputMessagesFilterDocument,
+    InputMessagesFilterGif, InputMessagesFilterRoundVideo
+)
 from telethon.tl.functions.messages import GetForumTopicsRequest
 import config  # 匯入設定
 
@@ -14,6 +17,10 @@ SESSION_NAME = 'user_session'
 MEDIA_FILE = 'media_index.json'    # 媒體資料庫
 STATUS_FILE = 'scan_status.json'   # 狀態與 Topic 對照表
 
+# 伺服器端過濾：只抓照片/影片與文件 (GIF 與圓形影片不在這兩者的結果中，另外查詢)
+MEDIA_FILTERS = (InputMessagesFilterPhotoVideo, InputMessagesFilterDocument,
+                 InputMessagesFilterGif, InputMessagesFilterRoundVideo)
+
 # 支援的副檔名 (白名單)
 VALID_EXTENSIONS = {
     '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm',
@@ -57,6 +64,24 @@ def is_target_media(msg):
             media_type = "video" if mime.startswith('video/') else "photo"
     return media_type, ext
 
+async def _next_or_none(it):
+    try: return await it.__anext__()
+    except StopAsyncIteration: return None
+
+async def iter_media_messages(chat_id, min_id=0, max_id=0):
+    """以伺服器端過濾器抓取 min_id 之後 (到 max_id 為止) 的媒體訊息 (依 ID 由舊到新合併，去除重複)"""
+    streams = [client.iter_messages(chat_id, min_id=min_id, reverse=True, filter=f) for f in MEDIA_FILTERS]
+    heads = [await _next_or_none(it) for it in streams]
+    last_yielded = min_id
+    while any(heads):
+        i = min((i for i, m in enumerate(heads) if m), key=lambda i: heads[i].id)
+        message = heads[i]
+        heads[i] = await _next_or_none(streams[i])
+        if message.id <= last_yielded: continue
+        if max_id and message.id > max_id: break
+        last_yielded = message.id
+        yield message
+
 # --- Topic 管理核心 (Topic Management) ---
 async def get_topic_map(chat_entity, chat_id, force_refresh=False):
     """
@@ -240,8 +265,12 @@ async def incremental_scan_handler(event):
 
     has_refreshed_map = False # 標記本次是否已經因為發現新 Topic 而刷新過
 
-    # 2. 增量遍歷
-    async for message in client.iter_messages(chat_id, min_id=last_id, reverse=True):
+    # 最新 ID 先查詢 (非媒體訊息不在過濾結果中)，當作本次掃描上限；掃描期間的新訊息留給下次
+    latest = await client.get_messages(chat_id, limit=1)
+    upper_id = latest[0].id if latest else 0
+
+    # 2. 增量遍歷 (只抓媒體訊息)
+    async for message in iter_media_messages(chat_id, min_id=last_id, max_id=upper_id):
         if message.id > latest_msg_id: latest_msg_id = message.id
         
         m_type, ext = is_target_media(message)
@@ -275,6 +304,8 @@ async def incremental_scan_handler(event):
             new_records.append(record)
             added_stats[t_name] += 1
 
+    if upper_id > latest_msg_id: latest_msg_id = upper_id
+
     # 3. 存檔
     if new_records:
         media_data.extend(new_records)
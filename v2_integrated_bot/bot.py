@@ -1,14 +1,17 @@
-import random
 import asyncio
 import sys
+import time
 from telethon import TelegramClient, events, Button
 import scanner_lib  # 匯入工具庫
+import play_lib  # 播放端資料結構
+import client_lib  # user_client 請求排程 (限速 / FloodWait)
 import config  # 匯入設定
 
 # 讀取設定檔參數
 API_ID = config.API_ID
 API_HASH = config.API_HASH
 BOT_TOKEN = config.BOT_TOKEN
+SCAN_CONCURRENCY = getattr(config, 'SCAN_CONCURRENCY', scanner_lib.SCAN_CONCURRENCY)
 
 # 檔案路徑
 SESSION_NAME = 'user_session'
@@ -19,7 +22,7 @@ TAG_FILE = 'tag.json'
 STATUS_FILE = 'scan_status.json'
 
 # --- 初始化雙客戶端 ---
-user_client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+user_client = client_lib.ThrottledClient(SESSION_NAME, API_ID, API_HASH)
 bot_client = TelegramClient(BOT_SESSION, API_ID, API_HASH)
 
 # --- 全域變數 ---
@@ -27,23 +30,25 @@ user_states = {}
 bot_info = None
 
 # 資料容器 (會在 load_data 中初始化)
-MEDIA_INDEX = []
-FAVORITES = []
+INDEX = scanner_lib.INDEX  # 搜尋索引 (掃描/刪除時由 scanner_lib 增量更新)
 TAG_DATA = {}
-SEARCH_INDEX_ALL = {}
-SEARCH_INDEX_FAV = {}
+TAG_COUNTS = play_lib.TagCounts()  # 選單標籤數量 (隨索引增量更新)
+INDEX.observers.append(TAG_COUNTS.on_change)
+POOLS = play_lib.AlbumPools(INDEX)  # 隨機播放用的相簿抽樣池
+BAGS = play_lib.ShuffleBags(POOLS)  # 每位使用者的不重複洗牌袋
+REVIEWS = play_lib.ReviewQueue(POOLS)  # 複習模式的到期排程
+SAMPLER = play_lib.WeightedSampler(POOLS)  # 加權抽樣 (越舊/未看優先)
+MODE_TEXT = {'all': "全庫隨機", 'fav': "收藏夾", 'review': "複習模式"}
+TRACKED_CHATS = set()  # 監控中的群組 (即時收錄用)
+TAGS_VERSION = 0  # 標籤版本 (每次 load_data +1，預抽批次用來判斷是否過期)
 
 # --- 資料讀寫與索引 ---
-def load_data():
-    """從檔案重新載入所有資料並建立索引 (確保與 Scanner 同步)"""
-    global MEDIA_INDEX, FAVORITES, TAG_DATA
-    global SEARCH_INDEX_ALL, SEARCH_INDEX_FAV
-    
-    MEDIA_INDEX = scanner_lib.load_json(MEDIA_FILE)
-    FAVORITES = scanner_lib.load_json(FAV_FILE)
+async def load_data():
+    """從資料庫重新載入所有資料並完整重建索引 (僅啟動與 /reload 使用)"""
+    global TAG_DATA, TAGS_VERSION
     
     # 讀取 Tag 並過濾掉 // 後面的註解
-    raw_tags = scanner_lib.load_json(TAG_FILE)
+    raw_tags = await scanner_lib.load_json_async(TAG_FILE)
     TAG_DATA = {}
     
     for major, minors in raw_tags.items():
@@ -55,20 +60,17 @@ def load_data():
                 clean_keys.append(clean_k)
             TAG_DATA[major][minor] = clean_keys
 
-    # 重建索引
-    SEARCH_INDEX_ALL = {}
-    for item in MEDIA_INDEX:
-        key = f"{item['group_id']}:{item['topic']}"
-        if key not in SEARCH_INDEX_ALL: SEARCH_INDEX_ALL[key] = []
-        SEARCH_INDEX_ALL[key].append(item)
-        
-    SEARCH_INDEX_FAV = {}
-    for item in FAVORITES:
-        key = f"{item['group_id']}:{item['topic']}"
-        if key not in SEARCH_INDEX_FAV: SEARCH_INDEX_FAV[key] = []
-        SEARCH_INDEX_FAV[key].append(item)
+    TRACKED_CHATS.clear()
+    TRACKED_CHATS.update(int(cid) for cid in scanner_lib.load_status())
 
-load_data() # 初始載入
+    # 重建索引
+    media, favorite_keys = await asyncio.gather(scanner_lib.run_io(scanner_lib.load_media),
+                                                scanner_lib.run_io(scanner_lib.load_favorite_keys))
+    INDEX.rebuild(media, favorite_keys)
+    TAG_COUNTS.rebuild(TAG_DATA, INDEX)
+    POOLS.clear()
+    await asyncio.gather(REVIEWS.load(), SAMPLER.load(), BAGS.load())
+    TAGS_VERSION += 1
 
 def get_state(user_id):
     if user_id not in user_states:
@@ -81,7 +83,9 @@ def get_state(user_id):
             "last_bot_msg_ids": [],
             "adding_mode": False,    
             "added_temp": [],         
-            "refresh_selected": set()
+            "refresh_selected": set(),
+            "weightings": {},         # selection_key -> 抽樣方式 (play_lib.WEIGHTINGS)
+            "prefetch": None          # 背景預抽的下一批 (asyncio.Task)
         }
     return user_states[user_id]
 
@@ -91,17 +95,20 @@ def chunks(lst, n):
 
 # --- 輔助函式 ---
 def get_tag_count(mode, major, minor=None):
-    index = SEARCH_INDEX_ALL if mode == 'all' else SEARCH_INDEX_FAV
-    target_keys = []
-    if minor:
-        target_keys = TAG_DATA.get(major, {}).get(minor, [])
-    else:
-        for m_list in TAG_DATA.get(major, {}).values():
-            target_keys.extend(m_list)     
-    count = 0
-    for k in target_keys:
-        if k in index: count += len(index[k])
-    return count
+    # 複習模式涵蓋全庫
+    return TAG_COUNTS.get('fav' if mode == 'fav' else 'all', major, minor)
+
+def make_progress_cb(msg, label, interval=2):
+    """掃描進度回報 (限制編輯頻率，避免觸發 Telegram 限流)"""
+    last_edit = 0
+    async def on_progress(done, total, title):
+        nonlocal last_edit
+        now = time.monotonic()
+        if done < total and now - last_edit < interval: return
+        last_edit = now
+        try: await msg.edit(f"⏳ **{label}** ({done}/{total})\n最新完成：**[{title}]**")
+        except: pass
+    return on_progress
 
 def get_visual_width(s):
     """計算字串的視覺寬度 (中日韓=2, 英數=1)"""
@@ -125,15 +132,12 @@ def format_fixed_topic(s, limit_width=8, total_width=10):
 
 async def generate_review_table(sort_mode='date'):
     """生成群組活躍度報表"""
-    status_data = scanner_lib.load_json(STATUS_FILE)
+    status_data = scanner_lib.load_status()
     if not status_data: return "⚠️ 無任何掃描紀錄。"
 
     topic_counts = {}
     if sort_mode == 'count':
-        current_media = scanner_lib.load_json(MEDIA_FILE)
-        for item in current_media:
-            key = (item['group_id'], item['topic'])
-            topic_counts[key] = topic_counts.get(key, 0) + 1
+        topic_counts = await scanner_lib.run_io(scanner_lib.count_by_topic)
 
     groups_columns = {} 
     
@@ -206,6 +210,7 @@ async def start_handler(event):
         "🔄 **/update** - 立即同步所有群組 (增量)\n"
         "🛠️ **/refresh** - 群組維護 (全量/修復)\n"
         "➕ **/add** - 開啟/關閉 監控錄入模式\n"
+        "♻️ **/reload** - 重新載入標籤與索引\n"
         "❌ **/close** - 安全關閉系統"
     )
 
@@ -215,7 +220,8 @@ async def video_handler(event):
     if not bot_info: bot_info = await bot_client.get_me()
     buttons = [
         [Button.inline("🎲 全庫隨機", data="menu_all")],
-        [Button.inline("⭐ 我的收藏", data="menu_fav")]
+        [Button.inline("⭐ 我的收藏", data="menu_fav")],
+        [Button.inline("🧠 複習模式", data="menu_review")]
     ]
     await event.respond(f"🎬 **影音中心**\n請選擇模式：", buttons=buttons)
 
@@ -251,39 +257,49 @@ async def link_listener(event):
     if 't.me/' in event.text:
         chat_id, title = await scanner_lib.resolve_link_to_id(user_client, event.text)
         if chat_id:
-            status_data = scanner_lib.load_json(STATUS_FILE)
-            str_id = str(chat_id)
-            if str_id not in status_data:
-                status_data[str_id] = {"title": title, "last_id": 0}
-                scanner_lib.save_json(STATUS_FILE, status_data)
+            chat_status = scanner_lib.get_chat_status(chat_id)
+            if not chat_status:
+                scanner_lib.save_chat_status(chat_id, {"title": title, "last_id": 0})
+                TRACKED_CHATS.add(chat_id)
                 state['added_temp'].append(title)
                 await event.reply(f"✅ 已鎖定：`{chat_id}` ({title})")
             else:
-                await event.reply(f"⚠️ 已在名單中：**{status_data[str_id].get('title')}**")
+                await event.reply(f"⚠️ 已在名單中：**{chat_status.get('title')}**")
         else:
             await event.reply("❌ 無法解析連結。")
 
 @bot_client.on(events.NewMessage(pattern='/update'))
 async def update_handler(event):
-    status_data = scanner_lib.load_json(STATUS_FILE)
+    status_data = scanner_lib.load_status()
     if not status_data:
         await event.respond("⚠️ 名單為空，請先使用 `/add`。")
         return
     msg = await event.respond("⏳ **正在同步所有群組...**")
     total_added = 0; report_lines = []
-    for chat_id_str, data in status_data.items():
-        try:
-            added, line = await scanner_lib.run_incremental_scan(user_client, int(chat_id_str), data.get('title'))
-            if added > 0: total_added += added; report_lines.append(line)
-        except Exception as e: print(f"Error: {e}")
-    load_data()
+    # 一次查詢所有群組的最新 ID，沒有新訊息的群組直接略過
+    try: latest_ids = await scanner_lib.get_latest_ids(user_client, [int(cid) for cid in status_data])
+    except Exception as e: print(f"預檢失敗，改為全部掃描: {e}"); latest_ids = {}
+    targets = scanner_lib.filter_active_groups(status_data, latest_ids)
+    skipped = len(status_data) - len(targets)
+    # 預檢確認沒有新訊息的群組也算已同步
+    target_ids = {cid for cid, _ in targets}
+    scanner_lib.LIVE_SYNCED.update(int(cid) for cid in status_data if int(cid) not in target_ids)
+    results = await scanner_lib.run_scans(scanner_lib.run_incremental_scan, user_client, targets,
+                                          SCAN_CONCURRENCY, make_progress_cb(msg, "正在同步所有群組..."))
+    for _, title, result, error in results:
+        if error: print(f"Error [{title}]: {error}"); continue
+        added, line = result
+        if added > 0: total_added += added; report_lines.append(line)
     final_text = f"✅ **同步完成！**\n總計新增: {total_added} 則"
+    if skipped: final_text += f"\n💤 略過 {skipped} 個無新訊息的群組"
     if report_lines: final_text += "\n\n" + "\n".join(report_lines)
+    wait_stats = user_client.scheduler.summary()
+    if wait_stats: final_text += f"\n\n⏱️ **API 等待統計**\n{wait_stats}"
     await msg.edit(final_text)
 
 async def show_refresh_menu(event, user_id):
     state = get_state(user_id)
-    status_data = scanner_lib.load_json(STATUS_FILE)
+    status_data = scanner_lib.load_status()
     buttons = []
     for cid, data in status_data.items():
         title = data.get('title', cid)
@@ -301,12 +317,20 @@ async def refresh_handler(event):
     get_state(event.sender_id)['refresh_selected'] = set()
     await show_refresh_menu(event, event.sender_id)
 
+@bot_client.on(events.NewMessage(pattern='/reload'))
+async def reload_handler(event):
+    await scanner_lib.STATE.flush()  # 先寫入待寫的收藏，重建時才讀得到
+    await load_data()
+    await event.respond(f"♻️ 已重新載入標籤與索引 (v{INDEX.version})")
+
 @bot_client.on(events.NewMessage(pattern='/close'))
 async def close_handler(event):
     if event.sender_id != (await user_client.get_me()).id: return
     global bot_info
     if not bot_info: bot_info = await bot_client.get_me()
     await event.respond("👋 正在清理版面並關閉系統...")
+    await scanner_lib.STATE.flush()
+    await scanner_lib.run_io(scanner_lib.compact_db, force=True)
     try:
         msg_ids = [m.id async for m in user_client.iter_messages(bot_info.id, limit=100)]
         if msg_ids: await user_client.delete_messages(bot_info.id, msg_ids)
@@ -315,6 +339,29 @@ async def close_handler(event):
     await bot_client.disconnect()
     sys.exit(0)
 
+# ==========================
+#      即時收錄 (User Client)
+# ==========================
+@user_client.on(events.NewMessage(func=lambda e: e.chat_id in TRACKED_CHATS))
+async def live_ingest_handler(event):
+    # 更新內附的群組實體，標題變更不必等下次掃描查詢
+    await scanner_lib.PEERS.observe(event.chat)
+    try:
+        record = await scanner_lib.ingest_message(user_client, event.message, event.chat_id)
+        if record:
+            print(f"📥 即時收錄：[{record['group']}] {record['topic_name']} #{record['msg_id']}")
+    except Exception as e: print(f"即時收錄失敗: {e}")
+
+@user_client.on(events.MessageDeleted(func=lambda e: e.chat_id in TRACKED_CHATS))
+async def live_delete_handler(event):
+    # 只有頻道/超級群組的刪除事件帶有 chat_id，一般群組無法判斷來源故不處理
+    try:
+        removed = await scanner_lib.run_io(scanner_lib.delete_media, event.chat_id, event.deleted_ids)
+        if removed:
+            INDEX.remove(event.chat_id, event.deleted_ids)
+            print(f"🗑️ 即時移除：{event.chat_id} 共 {removed} 則")
+    except Exception as e: print(f"即時移除失敗: {e}")
+
 # ==========================
 #      Callback 處理
 # ==========================
@@ -336,20 +383,18 @@ async def callback_handler(event):
         total = len(selected_ids)
         await event.edit(f"🚀 **準備維護 {total} 個群組...**")
         final_report = "📊 **維護報告**\n\n"
-        for index, cid_str in enumerate(selected_ids, 1):
-            title = scanner_lib.load_json(STATUS_FILE).get(cid_str, {}).get('title', cid_str)
-            try:
-                await event.edit(f"⏳ ({index}/{total}) 維護中：**[{title}]** ...")
-                final_report += await scanner_lib.run_full_scan(user_client, int(cid_str), title) + "\n---\n"
-                load_data()
-            except Exception as e: final_report += f"❌ **[{title}]** 失敗: {e}\n"
+        targets = [(int(cid), scanner_lib.get_chat_status(cid).get('title', cid)) for cid in selected_ids]
+        results = await scanner_lib.run_scans(scanner_lib.run_full_scan, user_client, targets,
+                                              SCAN_CONCURRENCY, make_progress_cb(event, "維護中..."))
+        for _, title, result, error in results:
+            if error: final_report += f"❌ **[{title}]** 失敗: {error}\n"
+            else: final_report += result + "\n---\n"
         await event.edit(final_report + "\n✅ 完成。")
 
-    elif data in ['menu_all', 'menu_fav', 'back_to_major']:
-        if data == 'menu_all': state['mode'] = 'all'
-        if data == 'menu_fav': state['mode'] = 'fav'
+    elif data in ['menu_all', 'menu_fav', 'menu_review', 'back_to_major']:
+        if data != 'back_to_major': state['mode'] = data.split('_')[1]
         state['step'] = 'major'; state['minors'] = set()
-        mode_text = "全庫隨機" if state['mode'] == 'all' else "收藏夾"
+        mode_text = MODE_TEXT[state['mode']]
         btn_list = []
         for t in TAG_DATA.keys():
             count = get_tag_count(state['mode'], t)
@@ -370,14 +415,21 @@ async def callback_handler(event):
         else: state['minors'].add(tag)
         await show_minor_menu(event, user_id, state['major'])
 
+    elif data == 'cycle_weighting':
+        selection = play_lib.selection_key(state['mode'], state['major'], state['minors'])
+        options = list(play_lib.WEIGHTINGS)
+        current = state['weightings'].get(selection, 'shuffle')
+        state['weightings'][selection] = options[(options.index(current) + 1) % len(options)]
+        await show_minor_menu(event, user_id, state['major'])
+
     elif data == 'confirm_selection':
         if not state['minors']: return await event.answer("⚠️ 請選擇標籤！", alert=True)
         await event.edit("⏳ **運送影片中...**"); await execute_random_play(user_id)
 
     elif data == 'play_again':
-        await event.delete(); await execute_random_play(user_id)
+        await asyncio.gather(event.delete(), execute_random_play(user_id))
 
-    elif data in ['panel_fav', 'panel_del']:
+    elif data in ['panel_fav', 'panel_del', 'panel_skip']:
         state['selected_ids'] = set()
         await show_action_menu(event, user_id, data.split('_')[1])
     
@@ -390,19 +442,23 @@ async def callback_handler(event):
         await show_action_menu(event, user_id, parts[2])
 
     elif data == 'exec_fav':
-        if await process_items(user_id, 'fav') > 0:
-            scanner_lib.save_json(FAV_FILE, FAVORITES); load_data()
+        await process_items(user_id, 'fav')
         await event.answer("✅ 已收藏！", alert=True); await show_control_panel(event.chat_id, user_id)
 
+    elif data == 'exec_skip':
+        await process_items(user_id, 'skip')
+        await event.answer("⏭️ 已延後，稍後再複習", alert=True); await show_control_panel(event.chat_id, user_id)
+
     elif data == 'exec_del':
         if not state['selected_ids']: return await event.answer("⚠️ 未選擇項目")
         await event.edit("⚠️ **確定刪除？**", buttons=[[Button.inline("❌ 取消", data="panel_del"), Button.inline("🗑️ 確認", data="confirm_real_del")]])
 
     elif data == 'confirm_real_del':
         await event.edit("⏳ 刪除中...")
-        count = await process_items(user_id, 'del')
-        scanner_lib.save_json(MEDIA_FILE, MEDIA_INDEX); scanner_lib.save_json(FAV_FILE, FAVORITES); load_data()
-        await event.edit(f"🗑️ 已刪除 {count} 個項目。"); await asyncio.sleep(2); await show_control_panel(event.chat_id, user_id)
+        count, failed = await process_items(user_id, 'del')
+        await event.edit(f"🗑️ 已刪除 {count} 個項目。"); await asyncio.sleep(2)
+        note = f"⚠️ 刪除失敗 {len(failed)} 則: {', '.join(map(str, failed))}" if failed else None
+        await show_control_panel(event.chat_id, user_id, note)
 
     elif data == 'show_panel_home':
         await event.delete(); await show_control_panel(event.chat_id, user_id)
@@ -426,58 +482,163 @@ async def show_minor_menu(event, user_id, major):
         mark = "✅ " if m in state['minors'] else ""
         btns.append(Button.inline(f"{mark}{m} ({get_tag_count(state['mode'], major, m)})", data=f"toggle_tag_{m}"))
     rows = list(chunks(btns, 3))
+    if state['mode'] != 'review':
+        weighting = state['weightings'].get(play_lib.selection_key(state['mode'], major, state['minors']), 'shuffle')
+        rows.append([Button.inline(f"⚖️ 抽樣：{play_lib.WEIGHTINGS[weighting][0]}", data="cycle_weighting")])
     rows.append([Button.inline("🔙 上一步", data="back_to_major"), Button.inline(f"▶️ 開始 ({len(state['minors'])})", data="confirm_selection")])
     await event.edit(f"📂 **{major}**", buttons=rows)
 
+async def delete_bot_messages(msg_ids):
+    try: await user_client.delete_messages(bot_info.id, msg_ids)
+    except: pass
+
+def plan_forwards(units):
+    """依來源群組切分轉傳批次：同一群組合併成一次 forward_messages (每次最多 100 則，相簿不拆開)"""
+    batches = []
+    for group_id in dict.fromkeys(items[0]['group_id'] for items in units):
+        batch = []
+        for items in (u for u in units if u[0]['group_id'] == group_id):
+            if batch and sum(map(len, batch)) + len(items) > scanner_lib.ID_BATCH_SIZE:
+                batches.append((group_id, batch)); batch = []
+            batch.append(items)
+        if batch: batches.append((group_id, batch))
+    return batches
+
+async def forward_units(batches):
+    """
+    各群組批次同時轉傳 (FloodWait 由 user_client 的請求排程處理)。回傳 (成功的單位, 新訊息 ID)
+    轉傳後的訊息帶有媒體的 file reference，順便寫入快取供下次直接送出
+    """
+    async def forward(group_id, batch):
+        msg_ids = [i['msg_id'] for items in batch for i in items]
+        msgs = await user_client.forward_messages(bot_info.id, msg_ids, group_id)
+        if not isinstance(msgs, list): msgs = [msgs]
+        return batch, dict(zip(msg_ids, msgs))
+
+    async def send(group_id, batch):
+        try: results = [await forward(group_id, batch)]
+        except Exception as e:
+            # 整批失敗時逐一重試，單一單位的錯誤不影響同群組的其他單位
+            print(f"轉傳失敗 ({group_id})，改為逐一轉傳: {e}")
+            results = []
+            for items in batch:
+                try: results.append(await forward(group_id, [items]))
+                except Exception as e: print(f"轉傳失敗 ({group_id}/{items[0]['msg_id']}): {e}")
+        delivered = []; ids = []; refs = []
+        for units, msgs in results:
+            # 來源訊息已被刪除時該則回傳 None，整個單位不算送達
+            delivered.extend(items for items in units if all(msgs.get(i['msg_id']) for i in items))
+            ids.extend(m.id for m in msgs.values() if m)
+            refs.extend((group_id, mid, scanner_lib.media_ref_of(m)) for mid, m in msgs.items() if m)
+        return delivered, ids, [r for r in refs if r[2]]
+
+    delivered = []; new_ids = []; ref_rows = []
+    for batch, ids, refs in await asyncio.gather(*(send(g, b) for g, b in batches)):
+        delivered.extend(batch); new_ids.extend(ids); ref_rows.extend(refs)
+    if ref_rows: await scanner_lib.run_io(scanner_lib.save_media_refs, ref_rows)
+    return delivered, new_ids
+
+async def send_cached(cached):
+    """
+    快取命中的單位直接以 file reference 送出 (相簿一次送出)，不再從私人群組轉傳。
+    失敗 (多半是 file reference 過期) 的單位回傳給呼叫端改走轉傳，轉傳時會順便更新快取。
+    """
+    delivered = []; new_ids = []; stale = []
+    for items, refs in cached:
+        try:
+            msgs = await user_client.send_file(bot_info.id, refs if len(refs) > 1 else refs[0])
+            if not isinstance(msgs, list): msgs = [msgs]
+            delivered.append(items); new_ids.extend(m.id for m in msgs if m)
+        except Exception: stale.append(items)
+    return delivered, new_ids, stale
+
+def batch_key(state, count):
+    """預抽批次的有效條件：選擇、加權、數量、索引版本與標籤版本都沒變"""
+    selection = play_lib.selection_key(state['mode'], state['major'], state['minors'])
+    return (selection, state['weightings'].get(selection, 'shuffle'), count, INDEX.version, TAGS_VERSION)
+
+async def draw_batch(user_id, count):
+    """抽出下一批 (不更動洗牌袋/複習/播放統計，送出後才由 commit_batch 提交)"""
+    state = get_state(user_id)
+    target_keys = []
+    for m in state['minors']: target_keys.extend(TAG_DATA[state['major']].get(m, []))
+
+    key = batch_key(state, count)
+    selection, weighting = key[0], key[1]
+    bag_state = None
+    if state['mode'] == 'review':
+        units = REVIEWS.draw(target_keys, count)
+    elif weighting == 'shuffle':
+        units, bag_state = BAGS.draw(user_id, selection, state['mode'], target_keys, count)
+    else:
+        units = SAMPLER.draw(state['mode'], target_keys, weighting, count)
+    # 預先備好媒體參照：有快取的單位直接送檔，其餘依群組合併轉傳
+    refs = await scanner_lib.run_io(scanner_lib.load_media_refs, [(i['group_id'], i['msg_id']) for items in units for i in items])
+    cached = []; uncached = []
+    for items in units:
+        unit_refs = [refs.get((i['group_id'], i['msg_id'])) for i in items]
+        if all(unit_refs): cached.append((items, unit_refs))
+        else: uncached.append(items)
+    return {'key': key, 'units': units, 'bag_state': bag_state, 'cached': cached, 'batches': plan_forwards(uncached)}
+
+async def commit_batch(user_id, batch, played):
+    state = get_state(user_id)
+    selection, weighting = batch['key'][0], batch['key'][1]
+    if state['mode'] == 'review':
+        for items in played: await REVIEWS.grade(items, 'good')
+    elif weighting == 'shuffle': await BAGS.advance(user_id, selection, batch['bag_state'])
+    await SAMPLER.mark_shown(played)
+
+async def prefetch_batch(user_id, count):
+    """控制台顯示後在背景先抽好下一批，按下「再來」時只需送出"""
+    return await draw_batch(user_id, count)
+
+def take_prefetched(user_id, count):
+    """取出仍有效的預抽批次；標籤或索引變動、選擇改變時丟棄"""
+    state = get_state(user_id)
+    task, state['prefetch'] = state['prefetch'], None
+    if not task or not task.done() or task.cancelled() or task.exception(): return None
+    batch = task.result()
+    return batch if batch['key'] == batch_key(state, count) else None
+
+@client_lib.as_interactive
 async def execute_random_play(user_id, count=5):
     global bot_info
     state = get_state(user_id)
+    if not bot_info: bot_info = await bot_client.get_me()
+    # 清理上一批訊息與本次轉傳同時進行
+    cleanup = None
     if state['last_bot_msg_ids']:
-        try:
-            if not bot_info: bot_info = await bot_client.get_me()
-            await user_client.delete_messages(bot_info.id, state['last_bot_msg_ids'])
-        except: pass
+        cleanup = asyncio.create_task(delete_bot_messages(state['last_bot_msg_ids']))
         state['last_bot_msg_ids'] = []
 
-    target_keys = []
-    for m in state['minors']: target_keys.extend(TAG_DATA[state['major']].get(m, []))
-    
-    idx = SEARCH_INDEX_ALL if state['mode'] == 'all' else SEARCH_INDEX_FAV
-    candidates = []
-    for k in target_keys:
-        if k in idx: candidates.extend(idx[k])
-            
-    if not candidates: return await bot_client.send_message(user_id, f"⚠️ 找不到影片。")
-
-    grouped = {}
-    for item in candidates:
-        key = f"grp_{item['grouped_id']}" if item.get('grouped_id') else f"msg_{item['msg_id']}"
-        if key not in grouped: grouped[key] = []
-        grouped[key].append(item)
-
-    sel_keys = random.sample(list(grouped.keys()), min(len(grouped), count))
-    played = []; new_ids = []
-    if not bot_info: bot_info = await bot_client.get_me()
+    batch = take_prefetched(user_id, count) or await draw_batch(user_id, count)
+    if not batch['units']:
+        if cleanup: await cleanup
+        return await bot_client.send_message(user_id, f"⚠️ 找不到影片。")
 
-    for k in sel_keys:
-        items = sorted(grouped[k], key=lambda x: x['msg_id'])
-        played.append(items)
-        try:
-            msgs = await user_client.forward_messages(bot_info.id, [i['msg_id'] for i in items], items[0]['group_id'])
-            if not isinstance(msgs, list): msgs = [msgs]
-            new_ids.extend([m.id for m in msgs])
-            await asyncio.sleep(0.5)
-        except: pass
+    (sent, sent_ids, stale), (played, new_ids) = await asyncio.gather(
+        send_cached(batch['cached']), forward_units(batch['batches']))
+    played += sent; new_ids += sent_ids
+    if stale:
+        retried, retried_ids = await forward_units(plan_forwards(stale))
+        played += retried; new_ids += retried_ids
+    if cleanup: await cleanup
 
+    await commit_batch(user_id, batch, played)
     state['played_groups'] = played
     state['last_bot_msg_ids'] = new_ids
     await show_control_panel(user_id, user_id)
+    state['prefetch'] = asyncio.create_task(prefetch_batch(user_id, count))
 
-async def show_control_panel(chat_id, user_id):
+async def show_control_panel(chat_id, user_id, note=None):
     btns = [[Button.inline("❤️ 加入收藏", data="panel_fav"), Button.inline("🗑️ 刪除資源", data="panel_del")],
             [Button.inline("🔗 原始連結", data="panel_link")],
             [Button.inline("🔄 再來 5 則", data="play_again"), Button.inline("🔙 重選", data="back_to_major")]]
-    await bot_client.send_message(chat_id, "🎮 **資源控制台**", buttons=btns)
+    if get_state(user_id)['mode'] == 'review':
+        btns[1].append(Button.inline("⏭️ 跳過", data="panel_skip"))
+    text = "🎮 **資源控制台**" + (f"\n\n{note}" if note else "")
+    await bot_client.send_message(chat_id, text, buttons=btns)
 
 async def show_action_menu(event, user_id, action):
     state = get_state(user_id)
@@ -490,7 +651,7 @@ async def show_action_menu(event, user_id, action):
             if uid in state['selected_ids']: lbl = "✅ " + lbl
             r_btns.append(Button.inline(lbl, data=f"toggle_act_{action}_{uid}"))
         rows.append(r_btns)
-    confirm = "exec_fav" if action == 'fav' else "exec_del"
+    confirm = f"exec_{action}"
     rows.append([Button.inline("🔙 取消", data="show_panel_home"), Button.inline("確認", data=confirm)])
     await event.edit("請選擇項目：", buttons=rows)
 
@@ -506,30 +667,73 @@ async def show_link_menu(event, user_id):
     rows.append([Button.inline("🔙 返回", data="show_panel_home")])
     await event.edit("🔗 **原始連結**", buttons=rows)
 
+@client_lib.as_interactive
 async def process_items(user_id, action):
     state = get_state(user_id)
     targets = state['selected_ids']
     count = 0
+    if state['mode'] == 'review' and action in ('fav', 'skip'):
+        state['prefetch'] = None  # 評分改變到期時間，預抽批次作廢
+        # 複習模式：收藏 = 記得 (拉長間隔)，跳過 = 稍後再複習
+        for items in state['played_groups']:
+            if any(f"{i['group_id']}_{i['msg_id']}" in targets for i in items):
+                await REVIEWS.grade(items, 'easy' if action == 'fav' else 'again')
+                if action == 'skip': count += 1
     flat = [i for g in state['played_groups'] for i in g]
-    for item in flat:
-        if f"{item['group_id']}_{item['msg_id']}" in targets:
-            if action == 'fav':
-                if item not in FAVORITES: FAVORITES.append(item); count += 1
-            elif action == 'del':
-                try: await user_client.delete_messages(item['group_id'], [item['msg_id']])
-                except: pass
-                if item in MEDIA_INDEX: MEDIA_INDEX.remove(item)
-                if item in FAVORITES: FAVORITES.remove(item)
-                count += 1
-    return count
+    selected = [i for i in flat if f"{i['group_id']}_{i['msg_id']}" in targets]
+    failed = []
+    if action == 'fav':
+        for item in selected:
+            key = (item['group_id'], item['msg_id'])
+            if INDEX.get(*key) and not INDEX.is_favorite(*key):
+                scanner_lib.STATE.add_favorites([key]); INDEX.add_favorites([key]); count += 1
+    elif action == 'del':
+        by_chat = {}
+        for item in selected: by_chat.setdefault(item['group_id'], []).append(item['msg_id'])
+        results = await asyncio.gather(*(delete_confirmed(gid, ids) for gid, ids in by_chat.items()))
+        # 只有確認已刪除的訊息才從索引移除，並一次寫入資料庫
+        await scanner_lib.run_io(scanner_lib.delete_media_keys,
+                                 [(gid, m) for gid, (deleted, _) in zip(by_chat, results) for m in deleted])
+        for gid, (deleted, not_deleted) in zip(by_chat, results):
+            INDEX.remove(gid, deleted)
+            count += len(deleted); failed.extend(not_deleted)
+    return count, failed
+
+async def delete_confirmed(group_id, msg_ids):
+    """同一群組批次刪除，再以 get_messages 確認 (None 代表已刪除)；回傳 (已刪除, 失敗)"""
+    for batch in chunks(msg_ids, scanner_lib.ID_BATCH_SIZE):
+        try: await user_client.delete_messages(group_id, batch)
+        except Exception as e: print(f"刪除失敗 ({group_id}): {e}")
+    try: msgs = await user_client.get_messages(group_id, ids=msg_ids)
+    except Exception as e:
+        print(f"無法確認刪除結果 ({group_id}): {e}")
+        return [], msg_ids
+    deleted = [mid for mid, m in zip(msg_ids, msgs) if m is None]
+    return deleted, [mid for mid, m in zip(msg_ids, msgs) if m is not None]
+
+async def compact_loop(interval=600):
+    """背景定期合併 SQLite WAL 日誌，避免寫入時卡在 checkpoint"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            size = await scanner_lib.run_io(scanner_lib.compact_db)
+            if size: print(f"🧹 已合併 WAL 日誌 ({size // 1024} KB)")
+        except Exception as e: print(f"WAL 合併失敗: {e}")
 
 async def main():
     print("System Starting...")
+    # 舊版 JSON 資料一次性匯入 SQLite
+    if await scanner_lib.run_io(scanner_lib.needs_import):
+        await scanner_lib.run_io(scanner_lib.import_json_files, MEDIA_FILE, FAV_FILE, STATUS_FILE)
+    await load_data() # 初始載入
     await user_client.start()
     await bot_client.start(bot_token=BOT_TOKEN)
     global bot_info
     bot_info = await bot_client.get_me()
+    # 舊版以正數 chat_id 存下的群組 (公開連結 / v1 匯入) 換成 peer ID 後重新載入
+    if await scanner_lib.migrate_chat_ids(user_client): await load_data()
     print("✅ 雙核心系統已啟動")
+    asyncio.create_task(compact_loop())
     await asyncio.gather(user_client.run_until_disconnected(), bot_client.run_until_disconnected())
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import asyncio
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+from telethon import TelegramClient, errors
+
+# --- 設定區 ---
+# 各類 API 的速率 (每秒請求數, 最多可累積的突發數)
+RATE_LIMITS = {
+    'read': (5.0, 10),      # 搜尋 / 讀取訊息 / Topic 列表
+    'send': (1.0, 3),       # 轉傳 / 送出媒體
+    'delete': (1.0, 3),
+    'resolve': (0.5, 2),    # 解析使用者名稱 / 邀請連結 / 實體資訊
+    'other': (3.0, 5),
+}
+METHOD_CLASSES = {
+    'read': ('SearchRequest', 'GetHistoryRequest', 'GetMessagesRequest', 'GetForumTopicsRequest',
+             'GetPeerDialogsRequest', 'GetRepliesRequest'),
+    'send': ('ForwardMessagesRequest', 'SendMediaRequest', 'SendMultiMediaRequest', 'UploadMediaRequest'),
+    'delete': ('DeleteMessagesRequest',),
+    'resolve': ('ResolveUsernameRequest', 'CheckChatInviteRequest', 'GetChannelsRequest',
+                'GetFullChannelRequest', 'GetUsersRequest', 'GetChatsRequest'),
+}
+FLOOD_RETRY_LIMIT = 3       # 單一請求遇到 FloodWait 的重試次數 (唯一的重試層)
+INTERACTIVE, BACKGROUND = 'interactive', 'background'
+
+# 目前請求的優先權 (每個 Task 各自一份)；預設為背景 (掃描)
+PRIORITY = contextvars.ContextVar('priority', default=BACKGROUND)
+
+@contextmanager
+def interactive():
+    """區塊內的請求 (例如隨機播放) 優先於背景掃描"""
+    token = PRIORITY.set(INTERACTIVE)
+    try: yield
+    finally: PRIORITY.reset(token)
+
+def as_interactive(func):
+    """把整個 async 函式標記為互動請求"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with interactive(): return await func(*args, **kwargs)
+    return wrapper
+
+def method_class(request):
+    if isinstance(request, list): request = request[0]
+    name = type(request).__name__
+    for cls, names in METHOD_CLASSES.items():
+        if name in names: return cls
+    return 'other'
+
+class TokenBucket:
+    """令牌桶：rate 為每秒補充數，burst 為上限。有互動請求在等時，背景請求先讓出"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.interactive_waiting = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority):
+        urgent = priority == INTERACTIVE
+        self.interactive_waiting += urgent
+        try:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and (urgent or not self.interactive_waiting):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.rate, 0.05))
+        finally:
+            self.interactive_waiting -= urgent
+
+class RequestScheduler:
+    """
+    所有 user_client 請求的集中排程：依方法類別套用令牌桶，
+    任一請求遇到 FloodWait 時全域暫停指定秒數後重試，並記錄每類請求的等待時間。
+    """
+    def __init__(self, limits=RATE_LIMITS):
+        self.buckets = {cls: TokenBucket(*limit) for cls, limit in limits.items()}
+        self.paused_until = 0
+        # {(類別, 優先權): [請求數, 總等待秒數, 最長等待秒數]}
+        self.stats = defaultdict(lambda: [0, 0.0, 0.0])
+        self.flood_waits = 0
+
+    async def _wait_pause(self):
+        while (delay := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def call(self, send, request):
+        cls = method_class(request)
+        priority = PRIORITY.get()
+        start = time.monotonic()
+        for attempt in range(FLOOD_RETRY_LIMIT + 1):
+            await self._wait_pause()
+            await self.buckets.get(cls, self.buckets['other']).acquire(priority)
+            waited = time.monotonic() - start
+            try:
+                result = await send(request)
+                break
+            except errors.FloodWaitError as e:
+                # 整個帳號一起暫停，避免其他請求繼續觸發 FloodWait
+                self.flood_waits += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.seconds + 1)
+                print(f"⏳ FloodWait {e.seconds} 秒 ({type(request).__name__})，全部請求暫停")
+                if attempt == FLOOD_RETRY_LIMIT: raise
+        entry = self.stats[(cls, priority)]
+        entry[0] += 1; entry[1] += waited; entry[2] = max(entry[2], waited)
+        return result
+
+    def summary(self):
+        """各類請求的等待統計 (供報表顯示)"""
+        lines = []
+        for (cls, priority), (count, total, longest) in sorted(self.stats.items()):
+            if total >= 0.1:
+                lines.append(f"{cls}/{priority}: {count} 次，平均等待 {total / count:.2f}s，最長 {longest:.1f}s")
+        if self.flood_waits: lines.append(f"FloodWait: {self.flood_waits} 次")
+        return "\n".join(lines)
+
+class ThrottledClient(TelegramClient):
+    """所有 API 請求都經過 RequestScheduler；FloodWait 一律交給排程處理 (flood_sleep_threshold=0)"""
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('flood_sleep_threshold', 0)
+        super().__init__(*args, **kwargs)
+        self.scheduler = RequestScheduler()
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        async def send(req):
+            return await super(ThrottledClient, self).__call__(req, ordered=ordered, flood_sleep_threshold=0)
+        return await self.scheduler.call(send, request)
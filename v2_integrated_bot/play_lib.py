@@ -0,0 +1,440 @@
+import bisect
+import hashlib
+import heapq
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime
+import scanner_lib
+
+# --- 播放端資料結構 (標籤計數 / 抽樣池 / 複習排程) ---
+DAY = 86400
+REVIEW_DEFAULT_EASE = 2.5
+REVIEW_MIN_EASE = 1.3
+REVIEW_EASY_BONUS = 1.3      # 收藏：間隔額外放大
+REVIEW_AGAIN_DELAY = 600     # 跳過：10 分鐘後重新排入
+RANKED_CACHE_SIZE = 32       # 依 seed 排序好的桶最多保留幾份 (LRU)
+
+class TagCounts:
+    """
+    標籤數量的物化快取：(mode, major, minor) -> 數量，major 總數存於 minor=None。
+    建立 TAG_DATA 與索引時 rebuild 一次，之後透過 MediaIndex.observers 逐筆增減，選單只需查表。
+    """
+    def __init__(self):
+        self.counts = {}
+        self.bucket_tags = {}  # 'group_id:topic' -> [(major, minor), ...]
+
+    def rebuild(self, tag_data, index):
+        self.counts = {}
+        self.bucket_tags = {}
+        for major, minors in tag_data.items():
+            for minor, keys in minors.items():
+                for k in keys:
+                    if k not in self.bucket_tags: self.bucket_tags[k] = []
+                    self.bucket_tags[k].append((major, minor))
+        for mode, buckets in (('all', index.all), ('fav', index.fav)):
+            for bucket, items in buckets.items():
+                self.on_change(mode, bucket, len(items))
+
+    def on_change(self, mode, bucket, delta, item=None):
+        for major, minor in self.bucket_tags.get(bucket, ()):
+            for key in ((mode, major, minor), (mode, major, None)):
+                self.counts[key] = self.counts.get(key, 0) + delta
+
+    def get(self, mode, major, minor=None):
+        return self.counts.get((mode, major, minor), 0)
+
+
+def unit_rank(seed, unit):
+    """單位在某個 seed 下的洗牌順序 (63-bit 雜湊，可存入 SQLite INTEGER)，與其他單位的增刪無關"""
+    digest = hashlib.blake2b(f"{seed}:{unit_id(unit)}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+def selection_key(mode, major, minors):
+    return f"{mode}|{major}|{','.join(sorted(minors))}"
+
+def unit_id(unit):
+    """播放單位的識別字串 (相簿以 grouped_id、單則以 group_id/msg_id 表示)"""
+    first = unit[0]
+    if first.get('grouped_id'): return f"grp_{first['grouped_id']}"
+    return f"msg_{first['group_id']}_{first['msg_id']}"
+
+class AlbumPools:
+    """
+    每個 (mode, 'group_id:topic') 桶的播放單位：同一 grouped_id 的相簿合併成一個單位 (依 msg_id 排序)。
+    第一次用到時建立，之後依 MediaIndex.observers 逐筆增減：相簿單位就地修改 (各快取引用同一份清單)，
+    排序好的快取以 bisect 插入/移除單一單位，不重新排序整桶；索引 rebuild 後需呼叫 clear()。
+    observers 為 callback(mode, bucket, unit, delta)，單位出現 (+1) 或消失 (-1) 時通知。
+    """
+    def __init__(self, index):
+        self.index = index
+        self.pools = {}  # (mode, bucket) -> {unit_id: unit}
+        # (mode, bucket, seed) -> (ranks, units)；每份都是整桶的複製，只保留最近用到的幾份
+        self.ranked_pools = OrderedDict()
+        self.observers = []
+        index.observers.append(self.on_change)
+
+    def clear(self):
+        self.pools = {}
+        self.ranked_pools = OrderedDict()
+
+    def _notify(self, mode, bucket, unit, delta):
+        for callback in self.observers: callback(mode, bucket, unit, delta)
+
+    def _rerank(self, mode, bucket, unit, delta):
+        for (m, b, seed), (ranks, units) in self.ranked_pools.items():
+            if m != mode or b != bucket: continue
+            rank = unit_rank(seed, unit)
+            i = bisect.bisect_left(ranks, rank)
+            if delta > 0:
+                ranks.insert(i, rank); units.insert(i, unit)
+                continue
+            while i < len(ranks) and ranks[i] == rank and units[i] is not unit: i += 1
+            if i < len(ranks) and units[i] is unit:
+                del ranks[i]; del units[i]
+
+    def on_change(self, mode, bucket, delta, item):
+        pool = self.pools.get((mode, bucket))
+        if pool is None: return  # 尚未建立，第一次用到時才從索引讀取
+        uid = unit_id([item])
+        unit = pool.get(uid)
+        if delta > 0:
+            if unit is None:
+                pool[uid] = unit = [item]
+                self._rerank(mode, bucket, unit, 1)
+                self._notify(mode, bucket, unit, 1)
+                return
+            first = unit[0]
+            msg_ids = [i['msg_id'] for i in unit]
+            unit.insert(bisect.bisect_left(msg_ids, item['msg_id']), item)
+        else:
+            if unit is None: return
+            rest = [i for i in unit if i['msg_id'] != item['msg_id']]
+            if not rest:
+                del pool[uid]
+                self._rerank(mode, bucket, unit, -1)
+                self._notify(mode, bucket, unit, -1)
+                return
+            first = unit[0]
+            unit[:] = rest
+        if unit[0] is not first:
+            # 相簿的第一則改變 (發佈時間跟著變)：對觀察者視為移除後重新加入
+            self._notify(mode, bucket, unit, -1)
+            self._notify(mode, bucket, unit, 1)
+
+    def ranked(self, mode, bucket, seed):
+        """桶內單位依 unit_rank(seed) 排序後的 (ranks, units)；快取最近 RANKED_CACHE_SIZE 份，過期的重新排序即可"""
+        key = (mode, bucket, seed)
+        if key in self.ranked_pools:
+            self.ranked_pools.move_to_end(key)
+        else:
+            pairs = sorted(((unit_rank(seed, u), u) for u in self.get(mode, bucket)), key=lambda x: x[0])
+            self.ranked_pools[key] = ([r for r, _ in pairs], [u for _, u in pairs])
+            if len(self.ranked_pools) > RANKED_CACHE_SIZE: self.ranked_pools.popitem(last=False)
+        return self.ranked_pools[key]
+
+    def get(self, mode, bucket):
+        """桶內的單位清單 (新的 list，呼叫端可自行保留)"""
+        pool = self.pools.get((mode, bucket))
+        if pool is None:
+            source = (self.index.all if mode == 'all' else self.index.fav).get(bucket, {})
+            pool = {}
+            for item in source.values():
+                uid = unit_id([item])
+                if uid not in pool: pool[uid] = []
+                pool[uid].append(item)
+            for unit in pool.values(): unit.sort(key=lambda x: x['msg_id'])
+            self.pools[(mode, bucket)] = pool
+        return list(pool.values())
+
+class ShuffleBags:
+    """
+    每位使用者、每組 (mode, major, minors) 的不重複洗牌袋。
+    袋子只存 (seed, cursor)：單位依 unit_rank(seed) 由小到大播放，cursor 為已播放的最大 rank。
+    一輪播完才換新 seed，因此整輪內不會重複；中途新增的單位依 rank 落在本輪或下一輪，
+    刪除的單位自然消失，都不需要重建袋子。狀態存在資料庫 shuffle_bags 表，重啟後延續
+    (啟動時一次載入記憶體，之後只在 advance 時寫回)。
+    """
+    def __init__(self, pools):
+        self.pools = pools
+        self.bags = {}  # (user_id, selection) -> (seed, cursor)
+
+    async def load(self):
+        self.bags = await scanner_lib.run_io(scanner_lib.load_shuffle_bags)
+
+    @staticmethod
+    def new_seed():
+        return random.getrandbits(62)
+
+    @staticmethod
+    def _after(ranks, units, cursor):
+        for j in range(bisect.bisect_right(ranks, cursor), len(ranks)):
+            yield ranks[j], units[j]
+
+    def _tail(self, mode, buckets, seed, cursor):
+        """各桶 cursor 之後的單位，依 rank 合併 (惰性，不複製清單)"""
+        streams = [self._after(*self.pools.ranked(mode, b, seed), cursor) for b in dict.fromkeys(buckets)]
+        return heapq.merge(*streams, key=lambda x: x[0])
+
+    def draw(self, user_id, selection, mode, buckets, k):
+        """
+        抽出接下來的 k 個單位，回傳 (units, next_state)；
+        不會修改袋子，實際送出後再呼叫 advance(next_state)
+        """
+        seed, cursor = self.bags.get((user_id, selection)) or (self.new_seed(), -1)
+        units = []
+        taken = set()
+        for _ in range(2):  # 本輪剩餘不足時開新一輪補滿
+            for rank, unit in self._tail(mode, buckets, seed, cursor):
+                if len(units) >= k: break
+                uid = unit_id(unit)
+                if uid in taken: continue
+                units.append(unit); taken.add(uid); cursor = rank
+            if len(units) >= k: break
+            seed, cursor = self.new_seed(), -1
+        return units, (seed, cursor)
+
+    async def advance(self, user_id, selection, next_state):
+        self.bags[(user_id, selection)] = next_state
+        await scanner_lib.run_io(scanner_lib.save_shuffle_bag, user_id, selection, *next_state)
+
+def unit_timestamp(unit):
+    try: return datetime.fromisoformat(unit[0]['date']).timestamp()
+    except (KeyError, TypeError, ValueError): return 0.0
+
+class ReviewQueue:
+    """
+    間隔複習排程 (簡化 SM-2)：每個播放單位有 due (到期時間) 與 ease (間隔倍率)。
+    從未複習過的單位以發佈時間當作 due，越舊越優先。
+    每個桶一個最小堆 (due, unit_id)，只在第一次抽到該桶時建立；新單位與重新排程都直接 push，
+    被移除的單位與舊項目留在堆中，讀取時比對 due 視為失效 (lazy deletion)。
+    抽樣以輔助堆沿著堆的樹狀結構往下走，不需 pop，取前 k 個為 O(k log k)。
+    """
+    def __init__(self, pools, mode='all'):
+        self.pools = pools
+        self.mode = mode
+        self.schedule = {}  # unit_id -> [due, ease, interval]
+        self.heaps = {}     # bucket -> [(due, unit_id), ...]
+        self.units = {}     # bucket -> {unit_id: unit}
+        self.stale = {}     # bucket -> 失效項目數
+        pools.observers.append(self.on_change)
+
+    async def load(self):
+        self.schedule = await scanner_lib.run_io(scanner_lib.load_reviews)
+        self.heaps = {}; self.units = {}; self.stale = {}
+
+    def on_change(self, mode, bucket, unit, delta):
+        if mode != self.mode or bucket not in self.heaps: return
+        uid = unit_id(unit)
+        if delta > 0:
+            self.units[bucket][uid] = unit
+            heapq.heappush(self.heaps[bucket], (self._due(uid, unit), uid))
+        elif self.units[bucket].pop(uid, None) is not None:
+            self._add_stale(bucket)
+
+    def _add_stale(self, bucket):
+        self.stale[bucket] += 1
+        # 失效項目過多時丟掉整個堆，下次抽樣時重建
+        if self.stale[bucket] > len(self.units[bucket]):
+            self.heaps.pop(bucket); self.units.pop(bucket)
+
+    def _due(self, uid, unit):
+        entry = self.schedule.get(uid)
+        return entry[0] if entry else unit_timestamp(unit)
+
+    def _heap(self, bucket):
+        if bucket not in self.heaps:
+            units = {unit_id(u): u for u in self.pools.get(self.mode, bucket)}
+            heap = [(self._due(uid, u), uid) for uid, u in units.items()]
+            heapq.heapify(heap)
+            self.heaps[bucket] = heap; self.units[bucket] = units; self.stale[bucket] = 0
+        return self.heaps[bucket]
+
+    def _peek(self, bucket):
+        """依 due 由小到大產出 (due, uid, unit)，不修改堆"""
+        heap = self._heap(bucket)
+        units = self.units[bucket]
+        if not heap: return
+        frontier = [(heap[0], 0)]
+        while frontier:
+            (due, uid), i = heapq.heappop(frontier)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap): heapq.heappush(frontier, (heap[child], child))
+            if uid in units and self._due(uid, units[uid]) == due:
+                yield due, uid, units[uid]
+
+    def draw(self, buckets, k):
+        """從選取的桶中取出最逾期的 k 個單位 (不修改排程，送出後再呼叫 grade)"""
+        merged = heapq.merge(*(self._peek(b) for b in dict.fromkeys(buckets)), key=lambda x: (x[0], x[1]))
+        units = []
+        taken = set()
+        for _, uid, unit in merged:
+            if uid in taken: continue
+            units.append(unit); taken.add(uid)
+            if len(units) >= k: break
+        return units
+
+    async def grade(self, unit, grade, now=None):
+        """
+        重新排程：'good' = 已播放，'easy' = 加入收藏，'again' = 跳過 (降低 ease，稍後再出現)
+        """
+        now = now or time.time()
+        uid = unit_id(unit)
+        _, ease, interval = self.schedule.get(uid, (None, REVIEW_DEFAULT_EASE, 0))
+        if grade == 'again':
+            ease = max(REVIEW_MIN_EASE, ease - 0.2); interval = 0
+            due = now + REVIEW_AGAIN_DELAY
+        elif grade == 'easy':
+            ease += 0.15; interval = max(interval, DAY) * REVIEW_EASY_BONUS
+            due = now + interval
+        else:
+            interval = DAY if interval <= 0 else interval * ease
+            due = now + interval
+        self.schedule[uid] = [due, ease, interval]
+
+        bucket = scanner_lib.MediaIndex.key_of(unit[0])
+        if bucket in self.heaps:
+            heapq.heappush(self.heaps[bucket], (due, uid))
+            self._add_stale(bucket)
+        await scanner_lib.run_io(scanner_lib.save_review, uid, due, ease, interval)
+
+# --- 加權抽樣 (越舊 / 越少播放權重越高) ---
+# 抽樣方式：(按鈕文字, 權重函式(age_days, shows))；'shuffle' 使用 ShuffleBags
+WEIGHTINGS = {
+    'shuffle': ("🔀 洗牌", None),
+    'age': ("🕰️ 越舊越常", lambda age_days, shows: 1 + age_days / 30),
+    'unseen': ("🆕 未看優先", lambda age_days, shows: 1 / (1 + shows) ** 2),
+    'age_unseen': ("🕰️🆕 舊且未看", lambda age_days, shows: (1 + age_days / 30) / (1 + shows) ** 2),
+}
+
+class FenwickTree:
+    """權重的 Fenwick tree：單點更新、尾端新增、前綴和、依累積權重找位置皆為 O(log n)"""
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.weights = list(weights)
+        self.tree = [0.0] * (self.n + 1)
+        for i, w in enumerate(self.weights, 1):
+            self.tree[i] += w
+            parent = i + (i & -i)
+            if parent <= self.n: self.tree[parent] += self.tree[i]
+
+    def update(self, i, weight):
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def append(self, weight):
+        """新增位置 n：tree[n] 涵蓋 (n - lowbit(n), n]，由既有節點加總而來"""
+        self.weights.append(weight)
+        self.n += 1
+        node, j, stop = weight, self.n - 1, self.n - (self.n & -self.n)
+        while j > stop:
+            node += self.tree[j]
+            j -= j & -j
+        self.tree.append(node)
+
+    def total(self):
+        i = self.n; total = 0.0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """回傳最小的 i 使 weights[0..i] 的總和 > value"""
+        pos = 0
+        step = 1 << self.n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self.tree[nxt] <= value:
+                pos = nxt
+                value -= self.tree[nxt]
+            step >>= 1
+        return min(pos, self.n - 1)
+
+    def nonzero_near(self, i):
+        """浮點誤差可能讓 find() 落在權重為 0 的位置：往前 (再往後) 找最近有權重的位置，都沒有則為 -1"""
+        for j in range(min(i, self.n - 1), -1, -1):
+            if self.weights[j] > 0: return j
+        return next((j for j in range(i + 1, self.n) if self.weights[j] > 0), -1)
+
+class WeightedSampler:
+    """
+    加權隨機播放：每個 (mode, bucket, weighting) 一棵 Fenwick tree，權重由發佈時間與播放次數決定。
+    先依各桶總權重選桶，再在桶內以 find() 定位；抽出的單位暫時設為 0 以免重複，抽完再還原。
+    播放後 mark_shown() 更新次數並只調整該單位的權重 (O(log n))。
+    桶內新增的單位接在樹的尾端，移除的單位權重設為 0；空位超過一半時才丟掉整棵樹，下次抽樣重建。
+    """
+    def __init__(self, pools):
+        self.pools = pools
+        self.trees = {}  # (mode, bucket, weighting) -> (tree, units, positions)
+        self.stats = {}  # unit_id -> [shows, last_shown]
+        pools.observers.append(self.on_change)
+
+    async def load(self):
+        self.stats = await scanner_lib.run_io(scanner_lib.load_play_stats)
+        self.trees = {}
+
+    def on_change(self, mode, bucket, unit, delta):
+        uid = unit_id(unit)
+        for key in [k for k in self.trees if k[0] == mode and k[1] == bucket]:
+            tree, units, positions = self.trees[key]
+            if delta > 0:
+                if uid in positions: continue
+                positions[uid] = len(units); units.append(unit)
+                tree.append(self._weight(key[2], unit, time.time()))
+            elif uid in positions:
+                tree.update(positions.pop(uid), 0.0)
+                if len(positions) * 2 < tree.n: del self.trees[key]
+
+    def _weight(self, weighting, unit, now):
+        age_days = max(0.0, (now - unit_timestamp(unit)) / DAY) if unit_timestamp(unit) else 0.0
+        shows = self.stats.get(unit_id(unit), (0, 0))[0]
+        return WEIGHTINGS[weighting][1](age_days, shows)
+
+    def _tree(self, mode, bucket, weighting):
+        key = (mode, bucket, weighting)
+        if key not in self.trees:
+            now = time.time()
+            units = self.pools.get(mode, bucket)
+            tree = FenwickTree([self._weight(weighting, u, now) for u in units])
+            self.trees[key] = (tree, units, {unit_id(u): i for i, u in enumerate(units)})
+        return self.trees[key]
+
+    def draw(self, mode, buckets, weighting, k):
+        entries = [self._tree(mode, b, weighting) for b in dict.fromkeys(buckets)]
+        picked = []
+        zeroed = []
+        for _ in range(k):
+            live = [(e, t) for e, t in ((e, e[0].total()) for e in entries) if t > 0]
+            if not live: break
+            r = random.random() * sum(t for _, t in live)
+            # 浮點誤差可能讓 r 超出全部總和，此時落在最後一個有權重的桶
+            for entry, t in live:
+                if r < t: break
+                r -= t
+            tree, units, _ = entry
+            i = tree.nonzero_near(tree.find(min(r, t)))
+            if i < 0: break
+            picked.append(units[i])
+            zeroed.append((tree, i, tree.weights[i]))
+            tree.update(i, 0.0)
+        for tree, i, w in zeroed: tree.update(i, w)
+        return picked
+
+    async def mark_shown(self, units, now=None):
+        now = now or time.time()
+        rows = []
+        for unit in units:
+            uid = unit_id(unit)
+            shows = self.stats.get(uid, (0, 0))[0] + 1
+            self.stats[uid] = [shows, now]
+            rows.append((uid, shows, now))
+            bucket = scanner_lib.MediaIndex.key_of(unit[0])
+            for (mode, b, weighting), (tree, units_, positions) in self.trees.items():
+                if b == bucket and uid in positions:
+                    tree.update(positions[uid], self._weight(weighting, units_[positions[uid]], now))
+        await scanner_lib.run_io(scanner_lib.save_play_stats, rows)
@@ -1,14 +1,40 @@
+import asyncio
+import copy
+import functools
 import json
 import os
 import re
+import sqlite3
+import threading
+import time
 from collections import defaultdict
-from telethon import utils
-from telethon.tl.types import MessageService, MessageActionTopicCreate
-from telethon.tl.functions.messages import GetForumTopicsRequest
+from telethon import errors, utils
+from telethon.tl.types import (
+    MessageService, MessageActionTopicCreate, InputMessagesFilterPhotoVideo, InputMessagesFilterDocument,
+    InputMessagesFilterGif, InputMessagesFilterRoundVideo, ForumTopic,
+    InputDialogPeer, InputPhoto, InputDocument, InputPeerChannel, InputPeerChat, PeerChannel, PeerChat
+)
+from telethon.tl.functions.messages import GetForumTopicsRequest, SearchRequest, GetPeerDialogsRequest
 
 # --- 設定區 (與 Bot 共用) ---
 MEDIA_FILE = 'media_index.json'
 STATUS_FILE = 'scan_status.json'
+FAV_FILE = 'favorites.json'
+DB_FILE = 'media_index.db'
+SCAN_CONCURRENCY = 4        # 同時掃描的群組數
+ID_BATCH_SIZE = 100         # get_messages(ids=...) / forward_messages 單次上限
+TOPIC_CONCURRENCY = 4       # 論壇群組同時掃描的 Topic 數
+DIALOG_BATCH_SIZE = 100     # GetPeerDialogsRequest 單次查詢的群組數
+WAL_COMPACT_BYTES = 16 * 1024 * 1024  # WAL 日誌超過此大小才合併回主檔
+FLUSH_DELAY = 1.0           # 狀態/收藏變更合併寫入的延遲秒數
+CHECKPOINT_RECORDS = 500    # 掃描累積這麼多筆新紀錄就存一次進度
+CHECKPOINT_SECONDS = 30     # 或距離上次存檔超過這麼多秒
+PEER_TTL = 24 * 3600        # 群組標題快取的有效秒數 (access_hash 不會變，不受限制)
+IO_CONCURRENCY = 4          # 同時在 executor 中執行的阻塞 I/O 數 (超過就排隊等候)
+# 伺服器端過濾：只抓照片/影片與文件 (文件再交給 is_target_media 判斷副檔名)
+# GIF 與圓形影片不在 PhotoVideo / Document 的結果中，需另外查詢
+MEDIA_FILTERS = (InputMessagesFilterPhotoVideo, InputMessagesFilterDocument,
+                 InputMessagesFilterGif, InputMessagesFilterRoundVideo)
 VALID_EXTENSIONS = {
     '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm',
     '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.heic'
@@ -24,8 +50,492 @@ def load_json(filename):
     return {} if filename == STATUS_FILE else []
 
 def save_json(filename, data):
-    with open(filename, 'w', encoding='utf-8') as f:
+    # 先寫暫存檔再取代，寫到一半中斷也不會留下損壞的檔案
+    tmp = filename + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, filename)
+
+# --- 非同步 I/O：阻塞的 JSON / 資料庫操作丟到 executor 執行緒，不卡住事件迴圈 ---
+_io_sem = None
+
+async def run_io(func, *args, **kwargs):
+    """在 executor 中執行阻塞函式；以 semaphore 限制同時執行數，多餘的請求在迴圈上等待 (back-pressure)"""
+    global _io_sem
+    if _io_sem is None: _io_sem = asyncio.Semaphore(IO_CONCURRENCY)
+    async with _io_sem:
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def load_json_async(filename):
+    return await run_io(load_json, filename)
+
+# --- SQLite 資料庫 (媒體索引 / 收藏 / 掃描狀態) ---
+MEDIA_COLUMNS = ("group_id", "msg_id", "grp", "topic", "topic_name", "grouped_id", "type", "ext", "date")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    group_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    grp TEXT,
+    topic INTEGER NOT NULL,
+    topic_name TEXT,
+    grouped_id INTEGER,
+    type TEXT,
+    ext TEXT,
+    date TEXT,
+    PRIMARY KEY (group_id, msg_id)
+);
+CREATE INDEX IF NOT EXISTS idx_media_topic ON media (group_id, topic);
+CREATE TABLE IF NOT EXISTS favorites (
+    group_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    PRIMARY KEY (group_id, msg_id)
+);
+CREATE TABLE IF NOT EXISTS status (
+    chat_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    unit TEXT PRIMARY KEY,
+    due REAL NOT NULL,
+    ease REAL NOT NULL,
+    interval REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS play_stats (
+    unit TEXT PRIMARY KEY,
+    shows INTEGER NOT NULL,
+    last_shown REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shuffle_bags (
+    user_id INTEGER NOT NULL,
+    selection TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    cursor INTEGER NOT NULL,
+    PRIMARY KEY (user_id, selection)
+);
+CREATE TABLE IF NOT EXISTS media_refs (
+    group_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    access_hash INTEGER NOT NULL,
+    file_reference BLOB NOT NULL,
+    PRIMARY KEY (group_id, msg_id)
+);
+CREATE TABLE IF NOT EXISTS peers (
+    chat_id INTEGER PRIMARY KEY,
+    access_hash INTEGER,
+    title TEXT,
+    username TEXT,
+    updated REAL NOT NULL
+);
+"""
+
+_local = threading.local()  # 每個執行緒各自的連線 (背景寫入在 executor 執行緒中進行)
+DB_LOCK = threading.Lock()  # 背景寫入彼此互斥
+# 本次執行期間已完成增量同步的群組；只有這些群組的即時訊息可以推進 last_id (避免跳過停機期間的空窗)
+LIVE_SYNCED = set()
+
+def get_db():
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = _local.db = sqlite3.connect(DB_FILE, timeout=30)
+        db.row_factory = sqlite3.Row
+        # WAL：寫入只追加到 -wal 日誌，由 compact_db() 在背景合併
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA wal_autocheckpoint=0")
+        db.executescript(SCHEMA)
+    return db
+
+def compact_db(force=False):
+    """WAL 日誌超過門檻 (或 force) 時合併回主檔並截斷，回傳合併前的日誌大小"""
+    wal_file = DB_FILE + '-wal'
+    size = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+    if not force and size < WAL_COMPACT_BYTES: return 0
+    get_db().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return size
+
+def _row_to_record(row):
+    """資料列 -> 與 media_index.json 相同格式的 dict ('grp' 欄位對應 'group')"""
+    return {
+        "group": row["grp"], "group_id": row["group_id"],
+        "topic": row["topic"], "topic_name": row["topic_name"],
+        "msg_id": row["msg_id"], "grouped_id": row["grouped_id"],
+        "type": row["type"], "ext": row["ext"], "date": row["date"]
+    }
+
+def _record_to_row(item):
+    return (item['group_id'], item['msg_id'], item.get('group'), item.get('topic', 1), item.get('topic_name'),
+            item.get('grouped_id'), item.get('type'), item.get('ext'), item.get('date'))
+
+def load_media(group_id=None):
+    db = get_db()
+    if group_id is None: rows = db.execute("SELECT * FROM media")
+    else: rows = db.execute("SELECT * FROM media WHERE group_id = ?", (group_id,))
+    return [_row_to_record(r) for r in rows]
+
+def add_media(records):
+    """逐列寫入新紀錄，回傳實際寫入的紀錄 (已存在的 group_id/msg_id 會被忽略)"""
+    inserted = []
+    if not records: return inserted
+    db = get_db()
+    sql = f"INSERT OR IGNORE INTO media ({', '.join(MEDIA_COLUMNS)}) VALUES ({', '.join('?' * len(MEDIA_COLUMNS))})"
+    with db:
+        for item in records:
+            if db.execute(sql, _record_to_row(item)).rowcount: inserted.append(item)
+    return inserted
+
+def delete_media(group_id, msg_ids):
+    """刪除指定訊息 (連同收藏)"""
+    return delete_media_keys([(group_id, m) for m in msg_ids])
+
+def delete_media_keys(keys):
+    """一次交易刪除多個群組的訊息 (連同收藏與媒體參照)；keys: [(group_id, msg_id), ...]"""
+    keys = list(keys)
+    if not keys: return 0
+    db = get_db()
+    with db:
+        cur = db.executemany("DELETE FROM media WHERE group_id = ? AND msg_id = ?", keys)
+        db.executemany("DELETE FROM favorites WHERE group_id = ? AND msg_id = ?", keys)
+        db.executemany("DELETE FROM media_refs WHERE group_id = ? AND msg_id = ?", keys)
+    return cur.rowcount
+
+def rename_topic(group_id, topic, topic_name, group_title=None):
+    """Topic 改名：只更新該 Topic 底下的資料列"""
+    db = get_db()
+    with db:
+        if group_title is None:
+            cur = db.execute("UPDATE media SET topic_name = ? WHERE group_id = ? AND topic = ?",
+                             (topic_name, group_id, topic))
+        else:
+            cur = db.execute("UPDATE media SET topic_name = ?, grp = ? WHERE group_id = ? AND topic = ?",
+                             (topic_name, group_title, group_id, topic))
+    return cur.rowcount
+
+def get_max_msg_id(group_id):
+    row = get_db().execute("SELECT MAX(msg_id) FROM media WHERE group_id = ?", (group_id,)).fetchone()
+    return row[0] or 0
+
+def count_by_topic():
+    """{(group_id, topic): 數量}"""
+    rows = get_db().execute("SELECT group_id, topic, COUNT(*) FROM media GROUP BY group_id, topic")
+    return {(r[0], r[1]): r[2] for r in rows}
+
+def load_favorite_keys():
+    return [(r[0], r[1]) for r in get_db().execute("SELECT group_id, msg_id FROM favorites")]
+
+def add_favorites(keys):
+    """keys: [(group_id, msg_id), ...]"""
+    db = get_db()
+    with db:
+        cur = db.executemany("INSERT OR IGNORE INTO favorites (group_id, msg_id) VALUES (?, ?)", list(keys))
+    return cur.rowcount
+
+# --- 寫回快取 (掃描狀態 / 收藏) ---
+class StateStore:
+    """
+    掃描狀態與收藏以記憶體為準：變更只標記 dirty，延遲 FLUSH_DELAY 秒後合併成一次交易，
+    在 executor 執行緒中寫入資料庫，不卡住兩個客戶端共用的事件迴圈。沒有事件迴圈時直接寫入。
+    掃描進度也經由這裡寫入；flush 依序執行，較舊的快照不會在較新的之後才寫進資料庫。
+    """
+    def __init__(self, delay=FLUSH_DELAY):
+        self.delay = delay
+        self.status = None      # {chat_id(int): dict}，第一次使用時從資料庫載入
+        self.dirty = set()      # 待寫入的 chat_id
+        self.fav_adds = set()   # 待寫入的收藏 (group_id, msg_id)
+        self._timer = None
+        self._task = None       # 延遲寫入的 Task (保留參照，避免執行中被回收)
+        self._flush_lock = None
+
+    def _status(self):
+        if self.status is None:
+            rows = get_db().execute("SELECT chat_id, data FROM status ORDER BY rowid")
+            self.status = {r[0]: json.loads(r[1]) for r in rows}
+        return self.status
+
+    def load_status(self):
+        return {str(cid): data for cid, data in self._status().items()}
+
+    def get_chat_status(self, chat_id):
+        return copy.deepcopy(self._status().get(int(chat_id), {}))
+
+    def save_chat_status(self, chat_id, data):
+        self._status()[int(chat_id)] = copy.deepcopy(data)
+        self.dirty.add(int(chat_id)); self._schedule()
+
+    def update_chat_status(self, chat_id, apply):
+        """直接在目前的狀態上套用 apply(data)，不經過讀取-修改-寫回，不會蓋掉期間的其他寫入"""
+        apply(self._status().setdefault(int(chat_id), {}))
+        self.dirty.add(int(chat_id)); self._schedule()
+
+    def add_favorites(self, keys):
+        self.fav_adds.update(map(tuple, keys))
+        self._schedule()
+
+    def _take(self):
+        rows = [(cid, json.dumps(self.status[cid], ensure_ascii=False)) for cid in self.dirty]
+        fav_adds = self.fav_adds
+        self.dirty = set(); self.fav_adds = set()
+        return rows, fav_adds
+
+    @staticmethod
+    def _write(rows, fav_adds):
+        with DB_LOCK:
+            db = get_db()
+            with db:
+                db.executemany("INSERT INTO status (chat_id, data) VALUES (?, ?) "
+                               "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data", rows)
+                # 已被刪除的媒體不再補寫收藏
+                db.executemany("INSERT OR IGNORE INTO favorites (group_id, msg_id) SELECT ?, ? "
+                               "WHERE EXISTS (SELECT 1 FROM media WHERE group_id = ? AND msg_id = ?)",
+                               [k * 2 for k in fav_adds])
+
+    def _restore(self, rows, fav_adds):
+        # 寫入失敗：放回待寫清單 (期間的新變更優先)
+        self.dirty.update(cid for cid, _ in rows)
+        self.fav_adds.update(fav_adds)
+
+    def flush_now(self):
+        rows, fav_adds = self._take()
+        if rows or fav_adds: self._write(rows, fav_adds)
+
+    async def flush(self):
+        if self._timer: self._timer.cancel(); self._timer = None
+        if self._flush_lock is None: self._flush_lock = asyncio.Lock()
+        # 取快照與寫入都在鎖內，前一次寫入完成後才取下一份快照
+        async with self._flush_lock:
+            rows, fav_adds = self._take()
+            if not (rows or fav_adds): return
+            try: await asyncio.get_running_loop().run_in_executor(None, self._write, rows, fav_adds)
+            except Exception as e:
+                print(f"狀態寫入失敗: {e}")
+                self._restore(rows, fav_adds); self._schedule()
+
+    def _schedule(self):
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: return self.flush_now()
+        if self._timer is None:
+            self._timer = loop.call_later(self.delay, self._start_flush, loop)
+
+    def _start_flush(self, loop):
+        self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        self._timer = None
+        await self.flush()
+
+STATE = StateStore()
+
+def load_status():
+    """回傳與 scan_status.json 相同格式的 {str(chat_id): {...}}"""
+    return STATE.load_status()
+
+def get_chat_status(chat_id):
+    return STATE.get_chat_status(chat_id)
+
+def save_chat_status(chat_id, data):
+    STATE.save_chat_status(chat_id, data)
+
+def update_chat_status(chat_id, apply):
+    STATE.update_chat_status(chat_id, apply)
+
+# --- 記憶體索引 ---
+class MediaIndex:
+    """
+    記憶體搜尋索引。紀錄以 (group_id, msg_id) 為 key 存在 records，收藏只是 key 的集合；
+    all / fav 依 'group_id:topic' 分桶，桶內為 {(group_id, msg_id): record}，收藏桶引用同一份紀錄。
+    掃描、即時收錄與刪除直接呼叫 add / remove / rename_topic 增量更新 (皆為 O(1) / 筆)，
+    只有啟動或手動 /reload 才需要 rebuild。version 每次變動 +1，供快取判斷是否過期。
+    observers 為 callback(mode, bucket, delta, item)，每筆增刪都會通知 (rebuild 不通知，由觀察者自行重建)。
+    """
+    def __init__(self):
+        self.records = {}
+        self.favorites = set()
+        self.all = {}
+        self.fav = {}
+        self.version = 0
+        self.observers = []
+
+    def _notify(self, mode, bucket, delta, item):
+        for callback in self.observers: callback(mode, bucket, delta, item)
+
+    @staticmethod
+    def key_of(item):
+        return f"{item['group_id']}:{item['topic']}"
+
+    def get(self, group_id, msg_id):
+        return self.records.get((group_id, msg_id))
+
+    def is_favorite(self, group_id, msg_id):
+        return (group_id, msg_id) in self.favorites
+
+    def rebuild(self, media, favorite_keys):
+        self.records = {}; self.favorites = set()
+        self.all = {}; self.fav = {}
+        self._insert(media, notify=False)
+        self._insert_favorites(favorite_keys, notify=False)
+        self.version += 1
+
+    def _insert(self, records, notify=True):
+        added = 0
+        for item in records:
+            rkey = (item['group_id'], item['msg_id'])
+            if rkey in self.records: continue
+            self.records[rkey] = item
+            bucket = self.key_of(item)
+            if bucket not in self.all: self.all[bucket] = {}
+            self.all[bucket][rkey] = item
+            if notify: self._notify('all', bucket, 1, item)
+            added += 1
+        return added
+
+    def _insert_favorites(self, keys, notify=True):
+        added = 0
+        for rkey in map(tuple, keys):
+            item = self.records.get(rkey)
+            if item is None or rkey in self.favorites: continue
+            self.favorites.add(rkey)
+            bucket = self.key_of(item)
+            if bucket not in self.fav: self.fav[bucket] = {}
+            self.fav[bucket][rkey] = item
+            if notify: self._notify('fav', bucket, 1, item)
+            added += 1
+        return added
+
+    def add(self, records):
+        added = self._insert(records)
+        if added: self.version += 1
+        return added
+
+    def add_favorites(self, keys):
+        added = self._insert_favorites(keys)
+        if added: self.version += 1
+        return added
+
+    def _discard(self, mode, bucket, rkey):
+        index = self.all if mode == 'all' else self.fav
+        item = index[bucket].pop(rkey, None) if bucket in index else None
+        if item is not None:
+            if not index[bucket]: del index[bucket]
+            self._notify(mode, bucket, -1, item)
+
+    def remove_favorites(self, keys):
+        removed = 0
+        for rkey in map(tuple, keys):
+            if rkey not in self.favorites: continue
+            self.favorites.discard(rkey)
+            self._discard('fav', self.key_of(self.records[rkey]), rkey)
+            removed += 1
+        if removed: self.version += 1
+        return removed
+
+    def remove(self, group_id, msg_ids):
+        """移除指定訊息 (全庫與收藏一起移除)，回傳移除筆數"""
+        self.remove_favorites([(group_id, m) for m in msg_ids])
+        removed = 0
+        for msg_id in msg_ids:
+            item = self.records.pop((group_id, msg_id), None)
+            if item is None: continue
+            self._discard('all', self.key_of(item), (group_id, msg_id))
+            removed += 1
+        if removed: self.version += 1
+        return removed
+
+    def rename_topic(self, group_id, topic, topic_name, group_title=None):
+        for item in self.all.get(f"{group_id}:{topic}", {}).values():
+            item['topic_name'] = topic_name
+            if group_title is not None: item['group'] = group_title
+        self.version += 1
+
+INDEX = MediaIndex()
+
+def load_shuffle_bags():
+    """{(user_id, selection): (seed, cursor)}"""
+    rows = get_db().execute("SELECT user_id, selection, seed, cursor FROM shuffle_bags")
+    return {(r[0], r[1]): (r[2], r[3]) for r in rows}
+
+def save_shuffle_bag(user_id, selection, seed, cursor):
+    db = get_db()
+    with db:
+        db.execute("INSERT INTO shuffle_bags (user_id, selection, seed, cursor) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT(user_id, selection) DO UPDATE SET seed = excluded.seed, cursor = excluded.cursor",
+                   (user_id, selection, seed, cursor))
+
+def load_reviews():
+    """{unit_id: [due, ease, interval]}"""
+    rows = get_db().execute("SELECT unit, due, ease, interval FROM reviews")
+    return {r[0]: [r[1], r[2], r[3]] for r in rows}
+
+def save_review(unit, due, ease, interval):
+    db = get_db()
+    with db:
+        db.execute("INSERT INTO reviews (unit, due, ease, interval) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT(unit) DO UPDATE SET due = excluded.due, ease = excluded.ease, interval = excluded.interval",
+                   (unit, due, ease, interval))
+
+def load_play_stats():
+    """{unit_id: [shows, last_shown]}"""
+    rows = get_db().execute("SELECT unit, shows, last_shown FROM play_stats")
+    return {r[0]: [r[1], r[2]] for r in rows}
+
+def save_play_stats(stats):
+    """stats: [(unit_id, shows, last_shown), ...]"""
+    db = get_db()
+    with db:
+        db.executemany("INSERT INTO play_stats (unit, shows, last_shown) VALUES (?, ?, ?) "
+                       "ON CONFLICT(unit) DO UPDATE SET shows = excluded.shows, last_shown = excluded.last_shown",
+                       list(stats))
+
+def media_ref_of(message):
+    """訊息 -> (kind, id, access_hash, file_reference)，無照片/文件則為 None"""
+    media = message.photo or message.document if message else None
+    if media is None: return None
+    return ('photo' if message.photo else 'document', media.id, media.access_hash, media.file_reference)
+
+def load_media_refs(keys, batch_size=400):
+    """{(group_id, msg_id): InputPhoto/InputDocument}，只回傳有快取的項目 (每 batch_size 筆一次查詢)"""
+    db = get_db(); refs = {}
+    keys = list(keys)
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        rows = db.execute("SELECT group_id, msg_id, kind, id, access_hash, file_reference FROM media_refs "
+                          f"WHERE (group_id, msg_id) IN (VALUES {', '.join(['(?, ?)'] * len(batch))})",
+                          [v for key in batch for v in key])
+        for row in rows:
+            cls = InputPhoto if row[2] == 'photo' else InputDocument
+            refs[(row[0], row[1])] = cls(id=row[3], access_hash=row[4], file_reference=row[5])
+    return refs
+
+def save_media_refs(rows):
+    """rows: [(group_id, msg_id, (kind, id, access_hash, file_reference)), ...]"""
+    db = get_db()
+    with db:
+        db.executemany("INSERT OR REPLACE INTO media_refs (group_id, msg_id, kind, id, access_hash, file_reference) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", [(g, m, *ref) for g, m, ref in rows])
+
+def needs_import():
+    """資料庫為空且舊 JSON 檔存在時才需要匯入"""
+    db = get_db()
+    if db.execute("SELECT 1 FROM media LIMIT 1").fetchone(): return False
+    if db.execute("SELECT 1 FROM status LIMIT 1").fetchone(): return False
+    return any(os.path.exists(f) for f in (MEDIA_FILE, STATUS_FILE, FAV_FILE))
+
+def import_json_files(media_file=MEDIA_FILE, fav_file=FAV_FILE, status_file=STATUS_FILE):
+    """一次性匯入舊版 JSON 檔 (可重複執行，不會產生重複資料)"""
+    media_data = load_json(media_file) if os.path.exists(media_file) else []
+    fav_data = load_json(fav_file) if os.path.exists(fav_file) else []
+    status_data = load_json(status_file) if os.path.exists(status_file) else {}
+
+    add_media(media_data)
+    # 收藏只存 Key；若收藏的紀錄不在索引中則一併補進 media
+    add_media(fav_data)
+    add_favorites([(i['group_id'], i['msg_id']) for i in fav_data])
+    for chat_id_str, data in status_data.items():
+        save_chat_status(chat_id_str, data)
+
+    print(f"✅ 匯入完成：媒體 {len(media_data)} / 收藏 {len(fav_data)} / 群組 {len(status_data)}")
+    return len(media_data), len(fav_data), len(status_data)
 
 def is_target_media(msg):
     media_type = None; ext = ""
@@ -40,6 +550,83 @@ def is_target_media(msg):
             media_type = "video" if mime.startswith('video/') else "photo"
     return media_type, ext
 
+# --- 群組實體快取 ---
+def _save_peer(chat_id, access_hash, title, username, updated):
+    db = get_db()
+    with db:
+        db.execute("INSERT OR REPLACE INTO peers (chat_id, access_hash, title, username, updated) VALUES (?, ?, ?, ?, ?)",
+                   (chat_id, access_hash, title, username, updated))
+
+class PeerCache:
+    """
+    群組的 access_hash / 標題 / username 快取 (與掃描狀態存在同一個資料庫)。
+    掃描與連結解析先查快取，標題超過 ttl 才向伺服器查詢；收到新訊息時順便以更新內附的實體刷新。
+    """
+    def __init__(self, ttl=PEER_TTL):
+        self.ttl = ttl
+        self.peers = None  # {chat_id: {...}}，第一次使用時從資料庫載入
+
+    def _all(self):
+        if self.peers is None:
+            rows = get_db().execute("SELECT chat_id, access_hash, title, username, updated FROM peers")
+            self.peers = {r[0]: dict(r) for r in rows}
+        return self.peers
+
+    def get(self, chat_id):
+        return self._all().get(int(chat_id))
+
+    def is_fresh(self, peer):
+        return peer is not None and peer['title'] is not None and time.time() - peer['updated'] < self.ttl
+
+    def find_username(self, username):
+        username = username.lower()
+        return next((p for p in self._all().values() if (p['username'] or '').lower() == username), None)
+
+    async def remember(self, entity):
+        """記下實體 (Channel / Chat)；內容沒變且未過期時不寫入"""
+        if entity is None or not hasattr(entity, 'title'): return None
+        chat_id = utils.get_peer_id(entity)
+        peer = {'chat_id': chat_id, 'access_hash': getattr(entity, 'access_hash', None),
+                'title': entity.title, 'username': getattr(entity, 'username', None), 'updated': time.time()}
+        old = self.get(chat_id)
+        if old and self.is_fresh(old) and all(old[k] == peer[k] for k in ('access_hash', 'title', 'username')):
+            return old
+        self._all()[chat_id] = peer
+        await run_io(_save_peer, *peer.values())
+        return peer
+
+    async def observe(self, entity):
+        """即時更新內附的實體：標題或 username 改變時才寫入"""
+        try: await self.remember(entity)
+        except Exception as e: print(f"實體快取更新失敗: {e}")
+
+    async def title(self, client, chat_id, default=None):
+        """群組標題：快取未過期就不查詢伺服器，查詢失敗時沿用舊標題"""
+        peer = self.get(chat_id)
+        if self.is_fresh(peer): return peer['title']
+        try: peer = await self.remember(await client.get_entity(chat_id))
+        except Exception: pass
+        return peer['title'] if peer and peer['title'] else default
+
+    async def input_entity(self, client, chat_id):
+        """以快取的 access_hash 直接組出 InputPeer，沒有快取才交給 client 解析並記下"""
+        peer = self.get(chat_id)
+        real_id, peer_type = utils.resolve_id(int(chat_id))
+        if peer and peer['access_hash'] is not None and peer_type is PeerChannel:
+            return InputPeerChannel(real_id, peer['access_hash'])
+        if peer and peer_type is PeerChat:
+            return InputPeerChat(real_id)
+        input_peer = await client.get_input_entity(chat_id)
+        # 以解析結果的 peer ID 記下 (未轉換的舊版正數 ID 會被解析成頻道，不能存在正數 key 底下)
+        peer_id = utils.get_peer_id(input_peer)
+        if isinstance(input_peer, InputPeerChannel) and not self.get(peer_id):
+            self._all()[peer_id] = peer = {'chat_id': peer_id, 'access_hash': input_peer.access_hash,
+                                           'title': None, 'username': None, 'updated': 0}
+            await run_io(_save_peer, *peer.values())
+        return input_peer
+
+PEERS = PeerCache()
+
 # --- 核心 ID 處理邏輯 ---
 async def resolve_link_to_id(client, link):
     try:
@@ -49,11 +636,15 @@ async def resolve_link_to_id(client, link):
                 raw_id = match.group(1)
                 chat_id = int(f"-100{raw_id}")
                 print(f"✅ (暴力解析) 捕獲 ID: {chat_id}")
-                return chat_id, f"待更新群組 ({raw_id})"
+                peer = PEERS.get(chat_id)
+                return chat_id, peer['title'] if peer and peer['title'] else f"待更新群組 ({raw_id})"
         else:
+            match = re.search(r't\.me/([A-Za-z0-9_]{4,})', link)
+            peer = PEERS.find_username(match.group(1)) if match else None
+            if PEERS.is_fresh(peer): return peer['chat_id'], peer['title']
             try:
-                entity = await client.get_entity(link)
-                return entity.id, entity.title
+                peer = await PEERS.remember(await client.get_entity(link))
+                return peer['chat_id'], peer['title']
             except Exception as e:
                 print(f"公開連結解析失敗: {e}")
                 pass
@@ -61,14 +652,67 @@ async def resolve_link_to_id(client, link):
         print(f"連結處理發生錯誤: {e}")
     return None, None
 
+# --- 舊版 chat_id 轉換 ---
+# 舊版 resolve_link_to_id 對公開連結回傳未加前綴的 entity.id (正數)，v1 匯入的資料也都是正數 ID；
+# 其餘地方 (事件、/c/ 連結) 使用帶 -100 前綴的 peer ID，兩者對不上會被重複掃描。
+def _migrate_chat_id(old_id, new_id):
+    """在同一交易中把 old_id 底下的資料搬到 new_id (new_id 已有的資料優先保留)"""
+    db = get_db()
+    old_prefix, new_prefix = f"msg_{old_id}_", f"msg_{new_id}_"
+    with db:
+        for table in ("media", "favorites", "media_refs"):
+            db.execute(f"UPDATE OR IGNORE {table} SET group_id = ? WHERE group_id = ?", (new_id, old_id))
+            db.execute(f"DELETE FROM {table} WHERE group_id = ?", (old_id,))
+        for table in ("reviews", "play_stats"):
+            db.execute(f"UPDATE OR IGNORE {table} SET unit = ? || substr(unit, ?) WHERE substr(unit, 1, ?) = ?",
+                       (new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix))
+            db.execute(f"DELETE FROM {table} WHERE substr(unit, 1, ?) = ?", (len(old_prefix), old_prefix))
+        if db.execute("SELECT 1 FROM status WHERE chat_id = ?", (new_id,)).fetchone():
+            db.execute("DELETE FROM status WHERE chat_id = ?", (old_id,))
+        else:
+            db.execute("UPDATE status SET chat_id = ? WHERE chat_id = ?", (new_id, old_id))
+
+async def migrate_chat_ids(client):
+    """
+    把掃描名單中的正數 chat_id 換成 peer ID：先當作頻道/超級群組解析，失敗再當作一般群組。
+    回傳 {舊 ID: 新 ID}；有轉換時需重新載入索引 (tag.json 中的舊 ID 需手動更新)。
+    """
+    await STATE.flush()
+    migrated = {}
+    for chat_id in [int(cid) for cid in load_status() if int(cid) > 0]:
+        for peer in (PeerChannel(chat_id), PeerChat(chat_id)):
+            try: entity = await client.get_entity(peer)
+            except Exception: continue
+            await PEERS.remember(entity)
+            migrated[chat_id] = utils.get_peer_id(entity)
+            break
+        else:
+            print(f"⚠️ 無法解析舊版 chat_id {chat_id}，保持原樣")
+    for old_id, new_id in migrated.items():
+        await run_io(_migrate_chat_id, old_id, new_id)
+        print(f"🔁 chat_id {old_id} -> {new_id} (tag.json 若有 {old_id}:<topic> 請改為 {new_id}:<topic>)")
+    if migrated: STATE.status = None  # 從資料庫重新載入
+    return migrated
+
 # --- Topic Map 工具 ---
+async def fetch_forum_topics(client, chat_id):
+    """分頁抓取全部 Topic (含 top_message)；非論壇群組會拋出例外 (呼叫端需讓 FloodWaitError 繼續往上拋)"""
+    input_channel = await PEERS.input_entity(client, chat_id)
+    topics = []
+    offset = 0
+    while True:
+        result = await client(GetForumTopicsRequest(input_channel, None, 0, offset, 100, ""))
+        if not result.topics: break
+        topics.extend(t for t in result.topics if isinstance(t, ForumTopic))
+        offset = result.topics[-1].id
+        if len(result.topics) < 100: break
+    return topics
+
 async def get_topic_map(client, chat_id, force_refresh=False):
     topic_map = {}
-    status_data = load_json(STATUS_FILE)
-    str_chat_id = str(chat_id)
 
     # 讀取快取
-    cached_map = status_data.get(str_chat_id, {}).get("topic_map", {})
+    cached_map = get_chat_status(chat_id).get("topic_map", {})
     if cached_map: topic_map.update(cached_map)
 
     if not force_refresh and cached_map:
@@ -78,15 +722,9 @@ async def get_topic_map(client, chat_id, force_refresh=False):
 
     # API 抓取
     try:
-        input_channel = await client.get_input_entity(chat_id)
-        offset = 0
-        while True:
-            result = await client(GetForumTopicsRequest(input_channel, None, 0, offset, 100, ""))
-            if not result.topics: break
-            for t in result.topics: topic_map[str(t.id)] = t.title
-            offset = result.topics[-1].id
-            if len(result.topics) < 100: break
-    except: pass 
+        for t in await fetch_forum_topics(client, chat_id): topic_map[str(t.id)] = t.title
+    except errors.FloodWaitError: raise  # 排程已放棄重試，不能退回走完整歷史
+    except Exception: pass  # 非論壇群組
 
     # 歷史訊息備援
     if not topic_map:
@@ -100,80 +738,244 @@ async def get_topic_map(client, chat_id, force_refresh=False):
     
     return topic_map
 
+async def iter_messages_by_ids(client, chat_id, msg_ids, batch_size=ID_BATCH_SIZE):
+    """依 ID 每 batch_size 筆抓一次，產出 (msg_id, message)；已刪除的訊息為 None"""
+    ids = sorted(msg_ids)
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        messages = await client.get_messages(chat_id, ids=batch)
+        for msg_id, message in zip(batch, messages):
+            yield msg_id, message
+
+async def _next_or_none(it):
+    try: return await it.__anext__()
+    except StopAsyncIteration: return None
+
+async def _iter_topic_search(client, chat_id, topic_id, message_filter, min_id=0, page_size=100):
+    """
+    在單一 Topic 內以過濾器搜尋 (由舊到新)。
+    iter_messages 指定 reply_to 時會改用 GetReplies 並忽略 filter，因此直接用 SearchRequest(top_msg_id)
+    """
+    peer = await PEERS.input_entity(client, chat_id)
+    cursor = min_id
+    while True:
+        result = await client(SearchRequest(
+            peer, "", message_filter(), None, None, offset_id=cursor + 1, add_offset=-page_size,
+            limit=page_size, max_id=0, min_id=cursor, hash=0, top_msg_id=topic_id
+        ))
+        entities = {utils.get_peer_id(x): x for x in list(result.users) + list(result.chats)}
+        page = sorted((m for m in result.messages if m.id > cursor), key=lambda m: m.id)
+        if not page: break
+        for message in page:
+            message._finish_init(client, entities, peer)
+            yield message
+        cursor = page[-1].id
+
+async def iter_media_messages(client, chat_id, min_id=0, topic_id=None, max_id=0):
+    """
+    以伺服器端過濾器抓取 min_id 之後的媒體訊息，多個過濾結果依 ID 由舊到新合併 (去除重複)
+    topic_id 有值時只搜尋該 Topic；max_id 有值時只抓到該 ID (含) 為止
+    """
+    if topic_id is None:
+        streams = [client.iter_messages(chat_id, min_id=min_id, reverse=True, filter=f) for f in MEDIA_FILTERS]
+    else:
+        streams = [_iter_topic_search(client, chat_id, topic_id, f, min_id) for f in MEDIA_FILTERS]
+    heads = [await _next_or_none(it) for it in streams]
+    last_yielded = min_id
+    while any(heads):
+        i = min((i for i, m in enumerate(heads) if m), key=lambda i: heads[i].id)
+        message = heads[i]
+        heads[i] = await _next_or_none(streams[i])
+        if message.id <= last_yielded: continue
+        if max_id and message.id > max_id: break
+        last_yielded = message.id
+        yield message
+
+async def get_latest_ids(client, chat_ids, batch_size=DIALOG_BATCH_SIZE):
+    """以 GetPeerDialogsRequest 批次取得各群組最新訊息 ID，回傳 {chat_id: top_message}"""
+    peers = []
+    for chat_id in chat_ids:
+        try: peers.append(InputDialogPeer(await PEERS.input_entity(client, chat_id)))
+        except Exception as e: print(f"無法取得 {chat_id} 的 Peer: {e}")
+
+    latest_ids = {}
+    for i in range(0, len(peers), batch_size):
+        result = await client(GetPeerDialogsRequest(peers[i:i + batch_size]))
+        for dialog in result.dialogs:
+            latest_ids[utils.get_peer_id(dialog.peer)] = dialog.top_message
+    return latest_ids
+
+def filter_active_groups(status_data, latest_ids):
+    """只留下最新 ID 超過 last_id 的群組 (查不到最新 ID 者仍照常掃描)"""
+    targets = []
+    for chat_id_str, data in status_data.items():
+        chat_id = int(chat_id_str)
+        latest = latest_ids.get(chat_id)
+        if latest is None or latest > data.get('last_id', 0):
+            targets.append((chat_id, data.get('title')))
+    return targets
+
+async def get_latest_msg_id(client, chat_id):
+    """只取最新一則訊息的 ID (推進 last_id 用)"""
+    messages = await client.get_messages(chat_id, limit=1)
+    return messages[0].id if messages else 0
+
+def get_topic_id(message):
+    """訊息所屬 Topic (無 reply 資訊者歸在 General = 1)"""
+    topic_id = 0
+    if message.reply_to:
+        topic_id = message.reply_to.reply_to_top_id or message.reply_to.reply_to_msg_id or 0
+    return topic_id or 1
+
+def build_record(message, m_type, ext, chat_id, chat_title, topic_id, topic_name):
+    return {
+        "group": chat_title,
+        "group_id": chat_id,
+        "topic": topic_id, "topic_name": topic_name,
+        "msg_id": message.id, "grouped_id": message.grouped_id,
+        "type": m_type, "ext": ext, "date": message.date.isoformat()
+    }
+
+async def _scan_forum_topics(client, chat_id, title, topics, topic_map, cursors, default_cursor, on_progress):
+    """
+    論壇群組：各 Topic 依自己的游標並行掃描，top_message 未超過游標的 Topic 直接略過
+    每則訊息以 on_progress(tid, msg_id, record) 回報 (非媒體 record 為 None)，由呼叫端累積並定期存檔
+    """
+    sem = asyncio.Semaphore(TOPIC_CONCURRENCY)
+
+    async def scan_topic(topic):
+        tid = str(topic.id)
+        async with sem:
+            async for message in iter_media_messages(client, chat_id, min_id=int(cursors.get(tid, default_cursor)),
+                                                     topic_id=topic.id, max_id=topic.top_message):
+                m_type, ext = is_target_media(message)
+                record = build_record(message, m_type, ext, chat_id, title, topic.id, topic_map.get(tid, topic.title)) if m_type else None
+                await on_progress(tid, message.id, record)
+        await on_progress(tid, topic.top_message, None)
+
+    pending = [t for t in topics if t.top_message > int(cursors.get(str(t.id), default_cursor))]
+    if len(pending) < len(topics):
+        print(f"💤 [{title}] 略過 {len(topics) - len(pending)} 個無新訊息的 Topic")
+    await asyncio.gather(*(scan_topic(t) for t in pending))
+
+async def commit_scan_progress(records, chat_id, apply):
+    """
+    先寫入新紀錄，再以 apply(data) 把掃描進度 (last_id / topic 游標) 合併進目前狀態並立即寫回，回傳實際寫入的紀錄。
+    進度一定晚於紀錄落地，中斷後重掃只會遇到已存在的紀錄
+    """
+    inserted = await run_io(add_media, records)
+    update_chat_status(chat_id, apply)
+    await STATE.flush()
+    return inserted
+
 # --- 功能 1: 增量掃描 (Bot /update 使用) ---
-async def run_incremental_scan(client, chat_id, chat_title="Group"):
+async def run_incremental_scan(client, chat_id, chat_title="Group", per_topic=True):
     """
     增量掃描：更新 Last ID，寫入新 Topic (不含 Topic 0)
+    per_topic=True 且為論壇群組時，改為逐 Topic 並行掃描 (見 _scan_forum_topics)
+    每累積 CHECKPOINT_RECORDS 筆或經過 CHECKPOINT_SECONDS 秒就連同進度存檔一次，
+    中斷後下次從最後的存檔點續掃，記憶體中只保留尚未存檔的紀錄
     """
-    try:
-        entity = await client.get_entity(chat_id)
-        current_title = entity.title
-    except:
-        current_title = chat_title
+    current_title = await PEERS.title(client, chat_id, chat_title)
 
-    status_data = load_json(STATUS_FILE)
-    media_data = load_json(MEDIA_FILE)
-    str_chat_id = str(chat_id)
+    chat_status = get_chat_status(chat_id)
 
-    last_id = status_data.get(str_chat_id, {}).get("last_id", 0)
-    if last_id == 0:
-        existing = [i['msg_id'] for i in media_data if i['group_id'] == chat_id]
-        if existing: last_id = max(existing)
+    last_id = chat_status.get("last_id", 0)
+    if last_id == 0: last_id = await run_io(get_max_msg_id, chat_id)
 
     topic_map = await get_topic_map(client, chat_id)
-    topic_last_ids = status_data.get(str_chat_id, {}).get("topic_last_ids", {})
+    topic_last_ids = chat_status.get("topic_last_ids", {})
     topic_last_active = {k: int(v) for k, v in topic_last_ids.items()}
+    topic_cursors = chat_status.get("topic_cursors", {})
+
+    forum_topics = None
+    if per_topic:
+        try: forum_topics = await fetch_forum_topics(client, chat_id)
+        except errors.FloodWaitError: raise
+        except Exception: forum_topics = None
 
-    new_records = []
     latest_msg_id = last_id
     added_stats = defaultdict(int) 
     has_refreshed_map = False
+    pending = []  # 尚未存檔的新紀錄
+    last_checkpoint = time.monotonic()
+    checkpoint_lock = asyncio.Lock()
 
-    async for message in client.iter_messages(chat_id, min_id=last_id, reverse=True):
-        if message.id > latest_msg_id: latest_msg_id = message.id
-        
-        m_type, ext = is_target_media(message)
-        if m_type:
-            topic_id = 0
-            if message.reply_to:
-                topic_id = message.reply_to.reply_to_top_id or message.reply_to.reply_to_msg_id or 0
-            if topic_id == 0: topic_id = 1
-            
-            str_topic = str(topic_id)
-            
-            if message.id > topic_last_active.get(str_topic, 0):
-                topic_last_active[str_topic] = message.id
+    def checkpoint_due():
+        return len(pending) >= CHECKPOINT_RECORDS or time.monotonic() - last_checkpoint >= CHECKPOINT_SECONDS
+
+    async def checkpoint(scanned_to=None):
+        nonlocal pending, last_checkpoint
+        async with checkpoint_lock:
+            records, pending = pending, []
+            last_checkpoint = time.monotonic()
+            # 存檔的 Map 移除 key "0"
+            scan_map = {k: v for k, v in topic_map.items() if k != "0"}
+
+            def apply(status):
+                # 以 max() 合併，掃描期間即時收錄推進的進度不會被開始時的舊資料蓋掉
+                status["topic_map"] = {**status.get("topic_map", {}), **scan_map}
+                status["title"] = current_title
+                for field, progress in (("topic_last_ids", topic_last_active), ("topic_cursors", topic_cursors)):
+                    if not progress: continue
+                    merged = status.setdefault(field, {})
+                    for tid, msg_id in progress.items(): merged[tid] = max(int(merged.get(tid, 0)), int(msg_id))
+                if scanned_to is not None: status["last_id"] = max(status.get("last_id", 0), scanned_to)
+
+            inserted = await commit_scan_progress(records, chat_id, apply)
+            # 只統計實際寫入的紀錄 (即時收錄已寫入的不算新增)
+            for record in inserted: added_stats[record['topic_name']] += 1
+            if inserted: INDEX.add(inserted)
 
-            if str_topic not in topic_map and not has_refreshed_map:
-                print(f"🆕 發現新 Topic ID ({str_topic})，正在同步名稱...")
-                topic_map = await get_topic_map(client, chat_id, force_refresh=True)
-                has_refreshed_map = True
+    def track(record):
+        str_topic = str(record['topic'])
+        if record['msg_id'] > topic_last_active.get(str_topic, 0):
+            topic_last_active[str_topic] = record['msg_id']
+        pending.append(record)
+
+    if forum_topics:
+        # Topic 列表剛抓下來，名稱直接同步
+        for t in forum_topics: topic_map[str(t.id)] = t.title
+        if "1" in topic_map: topic_map["0"] = topic_map["1"]
+
+        async def on_progress(tid, msg_id, record):
+            if record: track(record)
+            topic_cursors[tid] = msg_id  # 與紀錄同步推進，存檔時兩者一致
+            if checkpoint_due(): await checkpoint()
+
+        await _scan_forum_topics(client, chat_id, current_title, forum_topics, topic_map,
+                                 topic_cursors, last_id, on_progress)
+        latest_msg_id = max([latest_msg_id] + [t.top_message for t in forum_topics])
+    else:
+        # 先查最新 ID 當作本次掃描的上限 (非媒體訊息不在過濾結果中)，
+        # 掃描期間才發佈的訊息留給下次，last_id 不會越過過濾搜尋沒涵蓋到的訊息
+        try: upper_id = await get_latest_msg_id(client, chat_id)
+        except Exception as e:
+            print(f"[{current_title}] 取得最新 ID 失敗: {e}")
+            upper_id = 0
+        async for message in iter_media_messages(client, chat_id, min_id=last_id, max_id=upper_id):
+            if message.id > latest_msg_id: latest_msg_id = message.id
             
-            t_name = topic_map.get(str_topic, f"Unknown ({topic_id})")
-
-            new_records.append({
-                "group": current_title,
-                "group_id": chat_id,
-                "topic": topic_id, "topic_name": t_name,
-                "msg_id": message.id, "grouped_id": message.grouped_id,
-                "type": m_type, "ext": ext, "date": message.date.isoformat()
-            })
-            added_stats[t_name] += 1
-
-    if new_records:
-        media_data.extend(new_records)
-        save_json(MEDIA_FILE, media_data)
-    
-    # 準備存檔的 Map (移除 key "0")
-    map_to_save = topic_map.copy()
-    if "0" in map_to_save: del map_to_save["0"]
+            m_type, ext = is_target_media(message)
+            if m_type:
+                topic_id = get_topic_id(message)
+                str_topic = str(topic_id)
 
-    if str_chat_id not in status_data: status_data[str_chat_id] = {}
-    status_data[str_chat_id]["last_id"] = latest_msg_id
-    status_data[str_chat_id]["topic_map"] = map_to_save
-    status_data[str_chat_id]["topic_last_ids"] = topic_last_active
-    status_data[str_chat_id]["title"] = current_title
-    save_json(STATUS_FILE, status_data)
+                if str_topic not in topic_map and not has_refreshed_map:
+                    print(f"🆕 發現新 Topic ID ({str_topic})，正在同步名稱...")
+                    topic_map = await get_topic_map(client, chat_id, force_refresh=True)
+                    has_refreshed_map = True
+                
+                t_name = topic_map.get(str_topic, f"Unknown ({topic_id})")
+                track(build_record(message, m_type, ext, chat_id, current_title, topic_id, t_name))
+
+            # 由舊到新掃描，目前這則之前的紀錄都已在 pending 中，可安全推進 last_id
+            if checkpoint_due(): await checkpoint(scanned_to=message.id)
+
+        latest_msg_id = max(latest_msg_id, upper_id)
+
+    await checkpoint(scanned_to=latest_msg_id)
+    LIVE_SYNCED.add(chat_id)
 
     total_added = sum(added_stats.values())
     report = ""
@@ -184,54 +986,85 @@ async def run_incremental_scan(client, chat_id, chat_title="Group"):
     
     return total_added, report
 
+# --- 即時收錄 (user_client NewMessage 使用) ---
+async def ingest_message(client, message, chat_id):
+    """
+    即時收錄單則訊息：媒體寫入資料庫，並推進 topic_last_ids。
+    last_id / topic_cursors 只在該群組已同步過 (LIVE_SYNCED) 時推進，否則留給 /update 補齊空窗。
+    回傳新紀錄 (非媒體或已存在則為 None)
+    """
+    synced = chat_id in LIVE_SYNCED
+    record = None
+    new_map = None
+
+    m_type, ext = is_target_media(message)
+    if m_type:
+        topic_id = get_topic_id(message)
+        str_topic = str(topic_id)
+        topic_map = await get_topic_map(client, chat_id)
+        if str_topic not in topic_map:
+            topic_map = await get_topic_map(client, chat_id, force_refresh=True)
+            new_map = {k: v for k, v in topic_map.items() if k != "0"}
+        t_name = topic_map.get(str_topic, f"Unknown ({topic_id})")
+        title = get_chat_status(chat_id).get("title", "Group")
+
+        new_record = build_record(message, m_type, ext, chat_id, title, topic_id, t_name)
+        if await run_io(add_media, [new_record]):
+            record = new_record
+            INDEX.add([record])
+    if not (m_type or synced): return record
+
+    def apply(chat_status):
+        # 寫入當下才以 max() 合併，掃描存檔在上面的 await 期間推進的進度不會被舊資料覆蓋
+        if new_map is not None: chat_status["topic_map"] = new_map
+        if m_type:
+            topic_last_ids = chat_status.setdefault("topic_last_ids", {})
+            topic_last_ids[str_topic] = max(int(topic_last_ids.get(str_topic, 0)), message.id)
+            cursors = chat_status.get("topic_cursors", {})
+            if synced and str_topic in cursors: cursors[str_topic] = max(int(cursors[str_topic]), message.id)
+        if synced: chat_status["last_id"] = max(chat_status.get("last_id", 0), message.id)
+    update_chat_status(chat_id, apply)
+    return record
+
 # --- 功能 2: 全量維護 (Bot /refresh 使用) ---
-async def run_full_scan(client, chat_id, chat_title):
+async def run_full_scan(client, chat_id, chat_title, by_ids=True):
     """
     全量維護：刪除無效影片、回報改名 Topic，但不更新 Last ID
+    by_ids=True 時只依索引中的 msg_id 批次查詢 (API 次數與索引量成正比)，
+    False 則走完整歷史訊息
     """
-    try:
-        entity = await client.get_entity(chat_id)
-        chat_title = entity.title
-    except: pass
+    chat_title = await PEERS.title(client, chat_id, chat_title)
 
     # 1. 獲取 Telegram 上存活的 Topic
     live_topic_map = {}
     try:
-        input_channel = await client.get_input_entity(chat_id)
-        offset = 0
-        while True:
-            result = await client(GetForumTopicsRequest(input_channel, None, 0, offset, 100, ""))
-            if not result.topics: break
-            for t in result.topics: live_topic_map[str(t.id)] = t.title
-            offset = result.topics[-1].id
-            if len(result.topics) < 100: break
-    except: 
+        for t in await fetch_forum_topics(client, chat_id): live_topic_map[str(t.id)] = t.title
+    except errors.FloodWaitError: raise
+    except Exception:
         live_topic_map = await get_topic_map(client, chat_id, force_refresh=True)
 
     if "1" in live_topic_map: live_topic_map["0"] = live_topic_map["1"]
     else: live_topic_map["0"] = "General"; live_topic_map["1"] = "General"
 
-    media_data = load_json(MEDIA_FILE)
-    status_data = load_json(STATUS_FILE)
-    
-    other_data = [i for i in media_data if i['group_id'] != chat_id]
-    current_data = [i for i in media_data if i['group_id'] == chat_id]
+    current_data = await run_io(load_media, chat_id)
     old_map = {i['msg_id']: i for i in current_data}
     
     retained = []
     updated_names = 0
     topic_name_changes = {}
+    renamed_topics = {}
     
     # 2. 掃描本地檔案是否還在歷史訊息中
-    async for message in client.iter_messages(chat_id):
+    if by_ids:
+        source = (m async for _, m in iter_messages_by_ids(client, chat_id, old_map.keys()) if m)
+    else:
+        source = client.iter_messages(chat_id)
+
+    async for message in source:
         if message.id not in old_map: continue
         
         item = old_map[message.id]
-        
-        topic_id = 0
-        if message.reply_to:
-            topic_id = message.reply_to.reply_to_top_id or message.reply_to.reply_to_msg_id or 0
-        if topic_id == 0: topic_id = 1
+        topic_id = get_topic_id(message)
         
         curr_name = live_topic_map.get(str(topic_id), f"Unknown ({topic_id})")
         old_name = item.get('topic_name', '')
@@ -239,51 +1072,49 @@ async def run_full_scan(client, chat_id, chat_title):
         if old_name != curr_name:
             if str(topic_id) not in topic_name_changes:
                 topic_name_changes[str(topic_id)] = f"{old_name} ➝ {curr_name}"
-            item['topic_name'] = curr_name
-            item['group'] = chat_title 
-            updated_names += 1
+            renamed_topics[item['topic']] = curr_name
             
         retained.append(item)
     
     # 3. 計算刪除統計
     retained_ids = {i['msg_id'] for i in retained}
     deleted_stats = defaultdict(int)
-    deleted_count = 0
+    deleted_ids = []
     
     for item in current_data:
         if item['msg_id'] not in retained_ids:
             t_name = item.get('topic_name', 'Unknown')
             deleted_stats[t_name] += 1
-            deleted_count += 1
+            deleted_ids.append(item['msg_id'])
+    deleted_count = len(deleted_ids)
 
-    # 4. 構建最終的 Clean Topic Map
-    final_topic_map = live_topic_map.copy()
-    used_topic_ids = {str(i['topic']) for i in retained}
-    old_status_map = status_data.get(str(chat_id), {}).get("topic_map", {})
+    # 存檔 (只動到失效與改名的資料列)
+    await run_io(delete_media, chat_id, deleted_ids)
+    INDEX.remove(chat_id, deleted_ids)
+    for topic, name in renamed_topics.items():
+        updated_names += await run_io(rename_topic, chat_id, topic, name, chat_title)
+        INDEX.rename_topic(chat_id, topic, name, chat_title)
     
-    for tid in used_topic_ids:
-        if tid not in final_topic_map:
-            final_topic_map[tid] = old_status_map.get(tid, f"Unknown ({tid})")
-
-    # 5. 清理 Last IDs
-    old_last_ids = status_data.get(str(chat_id), {}).get("topic_last_ids", {})
-    new_last_ids = {}
-    for tid, msg_id in old_last_ids.items():
-        if tid in final_topic_map:
-            new_last_ids[tid] = msg_id
-
-    # 存檔 (Media & Status)
-    save_json(MEDIA_FILE, other_data + retained)
-    
-    str_chat_id = str(chat_id)
-    if str_chat_id not in status_data: status_data[str_chat_id] = {}
-    
-    if "0" in final_topic_map: del final_topic_map["0"]
-    
-    status_data[str_chat_id]["topic_map"] = final_topic_map
-    status_data[str_chat_id]["topic_last_ids"] = new_last_ids
-    status_data[str_chat_id]["title"] = chat_title
-    save_json(STATUS_FILE, status_data)
+    used_topic_ids = {str(i['topic']) for i in retained}
+
+    def apply(chat_status):
+        # 驗證期間很長，寫入當下才讀取目前狀態，保留即時收錄在期間推進的 last_id / 游標
+        # 4. 構建最終的 Clean Topic Map
+        final_topic_map = live_topic_map.copy()
+        old_status_map = chat_status.get("topic_map", {})
+        for tid in used_topic_ids:
+            if tid not in final_topic_map:
+                final_topic_map[tid] = old_status_map.get(tid, f"Unknown ({tid})")
+
+        # 5. 清理 Last IDs
+        old_last_ids = chat_status.get("topic_last_ids", {})
+        new_last_ids = {tid: msg_id for tid, msg_id in old_last_ids.items() if tid in final_topic_map}
+
+        if "0" in final_topic_map: del final_topic_map["0"]
+        chat_status["topic_map"] = final_topic_map
+        chat_status["topic_last_ids"] = new_last_ids
+        chat_status["title"] = chat_title
+    update_chat_status(chat_id, apply)
     
     report = f"✅ **[{chat_title}] 維護完成**\n"
     if deleted_count > 0:
@@ -299,4 +1130,36 @@ async def run_full_scan(client, chat_id, chat_title):
         for _, change_str in topic_name_changes.items():
             report += f"- `{change_str}`\n"
     
-    return report
\ No newline at end of file
+    return report
+
+# --- 功能 3: 多群組並行掃描 ---
+async def run_scans(scan_func, client, targets, concurrency=SCAN_CONCURRENCY, on_progress=None):
+    """
+    並行執行 scan_func(client, chat_id, title)，最多 concurrency 個群組同時進行。
+    FloodWait 由 client 的請求排程統一等待與重試 (見 client_lib.RequestScheduler)。
+    回傳與 targets 同順序的 [(chat_id, title, result, error), ...]
+    """
+    sem = asyncio.Semaphore(concurrency)
+    results = [None] * len(targets)
+    done = 0
+
+    async def worker(index, chat_id, title):
+        nonlocal done
+        result = error = None
+        try:
+            async with sem:
+                result = await scan_func(client, chat_id, title)
+        except Exception as e:
+            error = e
+        results[index] = (chat_id, title, result, error)
+        done += 1
+        if on_progress:
+            try: await on_progress(done, len(targets), title)
+            except Exception as e: print(f"進度回報失敗: {e}")
+
+    await asyncio.gather(*(worker(i, cid, t) for i, (cid, t) in enumerate(targets)))
+    return results
+
+if __name__ == '__main__':
+    # 一次性匯入：python scanner_lib.py
+    import_json_files()